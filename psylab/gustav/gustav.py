@@ -75,7 +75,7 @@ def info(experimentFile = None, frontend = None):
     exp.utils.process_variables(var)
     print(exp.utils.get_variable_strtable(var))
 
-def run(experimentFile = None, subjectID = None, frontend = None, recordData = None):
+def run(experimentFile = None, subjectID = None, frontend = None, recordData = None, profile = None):
 
     exp = utils.exp()
     exp.utils = utils
@@ -113,6 +113,8 @@ def run(experimentFile = None, subjectID = None, frontend = None, recordData = N
         raise Exception("Error importing experimental method: " + exp.method_str)
     exp.method = getattr(methodi, exp.method_str)
 
+    if profile is not None:
+        exp.profile = profile
     exp.utils.initialize_experiment( exp )
     if recordData is not None:
         exp.recordData = recordData
@@ -164,12 +166,18 @@ def run(experimentFile = None, subjectID = None, frontend = None, recordData = N
                 exp.run.trial_on = True
                 while exp.run.trial_on:
                     exp.utils.do_event(exp, 'pre_trial')
-                    exp.present_trial(exp)
-                    exp.prompt_response(exp)
+                    with exp.run.timer('get_stimulus'):
+                        exp.utils.get_stimulus(exp)
+                    with exp.run.timer('present_trial'):
+                        exp.present_trial(exp)
+                    exp.utils.prefetch_stimulus(exp)
+                    with exp.run.timer('prompt_response'):
+                        exp.prompt_response(exp)
                     exp.utils.do_event(exp, 'post_trial')
                     exp.run.trials_block += 1
                     exp.run.trials_exp += 1
 
+            exp.utils.discard_prefetched(exp)
             exp.utils.do_event(exp, 'post_block')
             exp.run.block += 1
             if exp.var.order != 'prompt' and exp.run.block == exp.run.nblocks:
@@ -177,15 +185,20 @@ def run(experimentFile = None, subjectID = None, frontend = None, recordData = N
 
     # End gustav_is_go loop
     exp.utils.do_event(exp, 'post_exp')
+    exp.utils.write_timing_report(exp)
+    exp.utils.write_profile_report(exp)
+    exp.utils.close_writer()
+    exp.utils.close_table(exp)
 
 def main(argv):
     experimentFile = None
     subjectID = None
     frontend = None
     recordData = None
+    profile = None
     action = 'run'
     try:
-        opts, args = getopt.getopt(argv, "hcdif:e:s:", ["help", "config", "dontrecord", "info", "frontend=", "experimentFile=", "subjectID="])
+        opts, args = getopt.getopt(argv, "hcdipf:e:s:", ["help", "config", "dontrecord", "info", "profile", "cprofile", "tracemalloc", "frontend=", "experimentFile=", "subjectID="])
     except (getopt.error, msg):
         print(msg)
         print("for help use --help")
@@ -206,12 +219,16 @@ def main(argv):
             recordData = False
         elif var in ("--info", "-i"):
             action = 'info'
+        elif var in ("--profile", "-p", "--cprofile", "--tracemalloc"):
+            profile = profile or ['time']
+            if var in ("--cprofile", "--tracemalloc"):
+                profile.append(var[2:])
     if action in ('config'):
         configure(experimentFile = experimentFile, frontend = frontend)
     elif action in ('list'):
         info(experimentFile = experimentFile, frontend = frontend)
     else:
-        run(experimentFile = experimentFile, subjectID = subjectID, frontend = frontend, recordData = recordData)
+        run(experimentFile = experimentFile, subjectID = subjectID, frontend = frontend, recordData = recordData, profile = profile)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
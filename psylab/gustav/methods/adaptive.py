@@ -227,6 +227,10 @@ def pre_block(exp):
     exp.var.dynamic['init_dir'] = 0
     exp.var.dynamic['n_reversals'] = 0
 
+def prefetch_next(exp):
+    # The next value of the track depends on the response
+    return False
+
 def post_trial(exp):
     exp.var.dynamic['cur_correct'] = str(exp.run.response)==str(exp.var.dynamic['correct'])
     track(exp)
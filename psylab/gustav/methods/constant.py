@@ -28,18 +28,30 @@
         'trialsperblock' : 10,
         'startblock' : 1,
         'starttrial' : 1,
+        'precompute' : False,
+        'processes' : None,
+        'precompute_maxbytes' : 512*1024*1024,
         }
 
     trialsperblock sets the number of trials to run for each block, or 
         combination of experimental variable levels. This parameter is required.
         
     startblock and starttrial are intended for crash recovery, and are optional.
+
+    If precompute is True, the stimuli for each block are built in parallel 
+        in pre_block, using a pool of processes (cpu count, by default) and 
+        holding up to precompute_maxbytes of stimuli at once. The experiment 
+        file must define stimulus_args(exp, trial) and build_stimulus(args); 
+        see utils.precompute_block. Optional.
 """
 
 constant_vars = {
     'trialsperblock' : 10,
     'startblock' : 1,
     'starttrial' : 1,
+    'precompute' : False,
+    'processes' : None,
+    'precompute_maxbytes' : 512*1024*1024,
     }
 
 def pre_exp(exp):
@@ -50,6 +62,9 @@ def pre_exp(exp):
         exp.var.constant['startblock'] = 1
     if not exp.var.constant.has_key('starttrial'):
         exp.var.constant['starttrial'] = 1
+    for key in ['precompute', 'processes', 'precompute_maxbytes']:
+        if key not in exp.var.constant:
+            exp.var.constant[key] = constant_vars[key]
 
     if exp.logString_pre_exp == None:
         exp.logString_pre_exp = "Experiment started: $name. Date: $date, Time: $time, Subject #: $subj\n"
@@ -71,9 +86,19 @@ def pre_block(exp):
     if exp.run.block == exp.var.constant['startblock'] - 1:
         exp.run.trials_block = exp.var.constant['starttrial'] - 1
         exp.run.trials_exp = (exp.var.constant['trialsperblock'] * (exp.var.constant['startblock']-1)) + (exp.run.trials_block)
+    if exp.var.constant['precompute']:
+        exp.utils.precompute_block(exp, range(exp.run.trials_block, exp.var.constant['trialsperblock']), 
+                                   exp.var.constant['processes'], exp.var.constant['precompute_maxbytes'])
+
+def prefetch_next(exp):
+    # Stimuli don't depend on responses, so the next one can be generated 
+    # ahead of time, as long as it is in the same block
+    return exp.run.trials_block < exp.var.constant['trialsperblock']-1
 
 def post_trial(exp):
     if exp.run.trials_block == exp.var.constant['trialsperblock']-1:
         exp.run.block_on = False
     exp.run.trial_on = False
 
+def post_exp(exp):
+    exp.utils.close_pool(exp)
@@ -23,16 +23,34 @@
 # cbrown1@pitt.edu.
 #
 
-import os, sys, fnmatch
+import os, sys, fnmatch, re
 import numpy as np
 import socket
 import datetime
 import codecs
 import types
 import collections
+import copy
+import hashlib
+import threading
+import multiprocessing
+import time
+import atexit
+import signal
+import sqlite3
+import json
 from time import sleep
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 from inspect import getmembers
 from functools import reduce
+import functools
 from .frontends import term
 
 #TODO: Modularize/standardize input methods. 
@@ -95,10 +113,22 @@ class exp:
     dataString_header = '#A data file for Gustav\n\n'#Write this string to datafile if the file is new
     dataFile ='$name.csv'
     dataFile_unexpanded =''
+    dataTable = None        # If set, also write a typed row per event to this sqlite file (see trial_table)
     recordData = True
+    bufferData = False      # Keep the data and log files open, and buffer writes (see open_writer).
+                            # Data then reaches the disk at the end of each block, not each trial
+    dataBufferSize = 65536  # Bytes to buffer per file
+    dataFsyncInterval = None# If set, fsync the data and log files at most this often (in seconds)
+    asyncWriter = False     # Write the data and log files on a background thread (see async_writer)
     comments = ''
     disable_functions = []          # Experimenter can add function names as strings to disable them
     quitKeys = ['/', 'q']
+    stimCacheSize = 256*1024*1024   # Max bytes of audio to hold in exp.stimCache
+    prefetch = False                # Generate the next stimulus during the response (see get_stimulus)
+    generate_stimulus = None        # Set from the experiment file, if it has one
+    timingReport = True             # Write event and trial timing stats to the log at the end (see trial_timer)
+    profile = []                    # Profile experiment functions: any of 'time', 'cprofile', 'tracemalloc' (see profiler)
+    profileFile = None              # If set, save cProfile stats here, for pstats
     eventTypes = [ 'pre_exp', 'pre_block', 'pre_trial', 'post_trial', 'post_block', 'post_exp' ]
     frontendTypes = ['qt', 'tk', 'term']
     from .frontends import term
@@ -193,6 +223,12 @@ class exp:
         trial_on = True
         gustav_is_go = True
         response = ''
+        prefetched = None  # The worker generating the next trial's stimulus
+        block_store = None # Stimuli precomputed for the current block
+        pool = None        # Process pool for precomputing stimuli
+        table = None       # The trial_table, if exp.dataTable is set
+        timer = None       # The trial_timer
+        profiler = None    # The profiler, if exp.profile is set
     
     
     class user:
@@ -209,6 +245,8 @@ class exp:
 def initialize_experiment( exp ):
     """Do stuff necessary for the start of an experiment
     """
+    if exp.bufferData or exp.asyncWriter:
+        open_writer(exp)
     logpath = os.path.split(exp.logFile)
     if not os.path.isdir(logpath[0]):
         print("Created logfile path: {}".format(logpath[0]))
@@ -230,6 +268,8 @@ def initialize_experiment( exp ):
 
     exp.utils.get_frontend(exp, exp.frontend)
     debug(exp, "Got frontend: {}".format(exp.frontend.name))
+    exp.stimCache = stim_cache(exp, exp.stimCacheSize)
+    exp.run.timer = trial_timer()
     # For each event type, look for a function in method, and in experiment.
     # If a function is found, add to list to be run during that event. 
     for event in exp.eventTypes:
@@ -254,6 +294,12 @@ def initialize_experiment( exp ):
     if hasattr(exp.experiment, "prompt_condition"):
         exp.prompt_condition = exp.experiment.prompt_condition
         debug(exp, "Found event in experiment: prompt_condition")
+    if hasattr(exp.experiment, "generate_stimulus"):
+        exp.generate_stimulus = exp.experiment.generate_stimulus
+        debug(exp, "Found event in experiment: generate_stimulus")
+    if exp.profile:
+        profile_functions(exp)
+        debug(exp, "Profiling experiment functions: {}".format(", ".join(exp.profile)))
 
     exp.utils.process_variables(exp)
     exp.run.nblocks = exp.var.nblocks
@@ -273,6 +319,10 @@ def initialize_experiment( exp ):
             debug(exp, "Created datafile: {}".format(exp.dataFile))
         else:
             debug(exp, "Found datafile: {}".format(exp.dataFile))
+        if exp.dataTable:
+            exp.dataTable = get_expanded_vals_in_string(exp.dataTable, exp)
+            exp.run.table = trial_table(exp.dataTable)
+            debug(exp, "Opened data table: {}".format(exp.dataTable))
     else:
         debug(exp, "Data will not be recorded")
 
@@ -480,7 +530,13 @@ def update_time(run):
 
 def write_data(data, filename):
     """Data IO.
+
+        If a session writer is open (see open_writer), data is written 
+        through it. Otherwise, the file is opened, appended to, and closed.
     """
+    if _writer is not None:
+        _writer.write(data, filename)
+        return
     if os.path.isfile(filename):
         f = codecs.open(filename, encoding='utf-8', mode='a')
     else:
@@ -491,6 +547,185 @@ def write_data(data, filename):
     f.close()
 
 
+class data_writer():
+    """Writes data and log files for a session, keeping them open
+
+        Each file is opened once, on the first write to it, and writes are 
+        buffered, so that saving data and logging each trial doesn't mean 
+        opening and closing files. Buffers are flushed by flush (which gustav 
+        calls at the start of the experiment and the end of each block), and 
+        by close. If fsync_interval is set, files are also fsync'd, at most 
+        that often.
+    """
+    def __init__(self, buffer_size=65536, fsync_interval=None):
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.files = collections.OrderedDict()
+        self.last_fsync = time.time()
+        self.lock = threading.RLock()
+
+    def write(self, data, filename):
+        with self.lock:
+            f = self.files.get(filename)
+            if f is None:
+                if os.path.isfile(filename):
+                    f = codecs.open(filename, encoding='utf-8', mode='a', buffering=self.buffer_size)
+                else:
+                    f = codecs.open(filename, encoding='utf-8', mode='w', buffering=self.buffer_size)
+                    f.write("# -*- coding: utf-8 -*-\n\n")
+                self.files[filename] = f
+            f.write(data)
+            if self.fsync_interval is not None and time.time() - self.last_fsync >= self.fsync_interval:
+                self.flush(fsync=True)
+
+    def flush(self, fsync=False):
+        with self.lock:
+            for f in self.files.values():
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+            if fsync:
+                self.last_fsync = time.time()
+
+    def close(self):
+        with self.lock:
+            self.flush(fsync=self.fsync_interval is not None)
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+class async_writer():
+    """Writes through a data_writer on a background thread
+
+        write only queues the data, so that logging and saving data never 
+        waits on the disk (or the network, if the data directory is on one). 
+        A single thread does the writing, so records are written in the order 
+        they were queued. flush waits until the queue is empty. An error on 
+        the writing thread is raised on the next call to write, flush or close.
+
+        info returns the current and maximum queue depth, and the mean and 
+        maximum write latency (the time from queueing a record to it being 
+        written), which debug includes in its output.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.files = writer.files
+        self.queue = queue.Queue()
+        self.error = None
+        self.writes = 0
+        self.max_depth = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                data, filename, t = item
+                self.writer.write(data, filename)
+                latency = _clock() - t
+                self.writes += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def write(self, data, filename):
+        self._raise()
+        self.queue.put((data, filename, _clock()))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def flush(self, fsync=False):
+        self.queue.join()
+        self.writer.flush(fsync)
+        self._raise()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
+        self._raise()
+
+    def info(self):
+        if self.writes:
+            mean = self.total_latency / self.writes
+        else:
+            mean = 0.
+        return {'depth': self.queue.qsize(), 'max_depth': self.max_depth, 'writes': self.writes,
+                'mean_latency': mean, 'max_latency': self.max_latency}
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+_writer = None
+_signal_handlers = {}
+
+def open_writer(exp):
+    """Opens a session writer (see data_writer), through which write_data, and 
+        so log, debug and save_data, will write until close_writer is called. 
+        If exp.asyncWriter is set, writes are done on a background thread 
+        (see async_writer).
+
+        Gustav opens one at the start of the experiment if exp.bufferData or 
+        exp.asyncWriter is set; both are off by default, in which case every 
+        write goes straight to disk. With a writer open, data is only 
+        guaranteed to be on disk after the pre_exp, post_block and post_exp 
+        events, when do_event flushes it, so a crash (or power loss) 
+        mid-block can lose that block's trials.
+
+        The writer is also flushed and closed at exit, and if the process is 
+        terminated (SIGTERM, SIGHUP), so that buffered data isn't lost.
+    """
+    global _writer
+    close_writer()
+    _writer = data_writer(exp.dataBufferSize, exp.dataFsyncInterval)
+    if exp.asyncWriter:
+        _writer = async_writer(_writer)
+    if isinstance(threading.current_thread(), threading._MainThread):
+        for name in ['SIGTERM', 'SIGHUP']:
+            signum = getattr(signal, name, None)
+            if signum is not None and signum not in _signal_handlers:
+                _signal_handlers[signum] = signal.signal(signum, _on_signal)
+
+def flush_writer(fsync=False):
+    """Flushes the session writer, if one is open
+    """
+    if _writer is not None:
+        _writer.flush(fsync)
+
+def close_writer():
+    """Flushes and closes the session writer, if one is open
+    """
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+def _on_signal(signum, frame):
+    close_writer()
+    handler = _signal_handlers.get(signum)
+    if callable(handler):
+        handler(signum, frame)
+    elif handler != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+atexit.register(close_writer)
+
+
 def save_data(exp, message):
     if exp.recordData:
         if message is not None and message != '':
@@ -515,7 +750,13 @@ def debug(exp, message):
     if exp.debug:
         time = datetime.datetime.now().strftime('%H:%M:%S')
         date = datetime.datetime.now().strftime('%Y-%m-%d')
-        dmessage = "DEBUG {},{}: {}".format(date, time, message)
+        if isinstance(_writer, async_writer):
+            info = _writer.info()
+            dmessage = "DEBUG {},{} [queue {} (max {}), write {:.2f} ms (max {:.2f} ms)]: {}".format(
+                       date, time, info['depth'], info['max_depth'], 
+                       info['mean_latency']*1000, info['max_latency']*1000, message)
+        else:
+            dmessage = "DEBUG {},{}: {}".format(date, time, message)
         if exp.logConsole:
             print(dmessage)
         if exp.logFile is not None and exp.logFile is not '':
@@ -525,6 +766,10 @@ def debug(exp, message):
 
         
 def do_event(exp, event):
+    t0 = _ns()
+    timer = exp.run.timer
+    if timer is not None and event == 'pre_block':
+        timer.new_block()
     debug(exp, "Begin Event: {}".format(event))
     exp.utils.update_time(exp.run)
     if hasattr(exp, "{}_".format(event)):
@@ -536,9 +781,737 @@ def do_event(exp, event):
         exp.utils.log(exp, getattr(exp, "logString_{}".format(event)))
     if hasattr(exp, "dataString_{}".format(event)):
         exp.utils.save_data(exp, getattr(exp, "dataString_{}".format(event)))
+    if exp.run.table is not None:
+        exp.run.table.write(exp, event)
     debug(exp, "End Event: {}".format(event))
-        
-        
+    if timer is not None:
+        timer.add(event, _ns() - t0)
+        if event == 'post_block':
+            timer.end_block("Block {} (condition {})".format(exp.run.block+1, exp.run.condition+1))
+    if event in ['pre_exp', 'post_block', 'post_exp']:
+        flush_writer()
+        if exp.run.table is not None:
+            exp.run.table.commit()
+
+
+if hasattr(time, 'perf_counter_ns'):
+    _ns = time.perf_counter_ns
+else:
+    _ns = lambda: int(_clock() * 1e9)
+
+class trial_timer():
+    """Records how long each phase of an experiment takes
+
+        Durations are measured with a monotonic clock, in nanoseconds. gustav 
+        times each event (pre_trial, post_trial, etc., including logging and 
+        saving data), and the stimulus generation (get_stimulus), 
+        present_trial and prompt_response phases of each trial. Anything else 
+        can be timed with:
+
+            with exp.run.timer('my_phase'):
+                ...
+
+        Stats (in ms) for the current block are available as template 
+        variables: $timing[phase] is the most recent duration, and 
+        $timing[phase.stat] is a stat, where stat is one of n, mean, p95, max 
+        or last. eg., exp.logString_post_block = "$timing[present_trial.p95]".
+
+        Stats are kept for each block and for the session, and report formats 
+        them as a table, which gustav writes to the log at the end of the 
+        experiment if exp.timingReport is set.
+    """
+    def __init__(self):
+        self.block = collections.OrderedDict()
+        self.session = collections.OrderedDict()
+        self.blocks = []
+        self.last = {}
+
+    def __call__(self, phase):
+        return _timed(self, phase)
+
+    def add(self, phase, ns):
+        """Records a duration, in ns
+        """
+        self.block.setdefault(phase, []).append(ns)
+        self.session.setdefault(phase, []).append(ns)
+        self.last[phase] = ns
+
+    def new_block(self):
+        self.block = collections.OrderedDict()
+
+    def end_block(self, label):
+        self.blocks.append((label, self.stats(self.block)))
+
+    def stats(self, durations=None):
+        """Returns an OrderedDict of phase: {n, mean, p95, max, last}, in ms, 
+            for the current block (or the given durations)
+        """
+        if durations is None:
+            durations = self.block
+        out = collections.OrderedDict()
+        for phase, d in durations.items():
+            d = np.array(d) / 1e6
+            out[phase] = {'n': len(d), 'mean': d.mean(), 'p95': np.percentile(d, 95), 
+                          'max': d.max(), 'last': d[-1]}
+        return out
+
+    def get(self, key):
+        """Returns a stat for the current block, as in $timing[key]
+        """
+        phase, _, stat = key.partition('.')
+        d = self.block.get(phase)
+        if not d:
+            return None
+        if stat in ['', 'last']:
+            return d[-1] / 1e6
+        return self.stats({phase: d})[phase].get(stat)
+
+    def report(self):
+        """Returns a table of the block and session stats, as comments
+        """
+        lines = ["# Timing (ms)"]
+        rows = self.blocks + [("Session", self.stats(self.session))]
+        for label, stats in rows:
+            lines.append("# {}".format(label))
+            lines.append("#   {:<16}{:>8}{:>10}{:>10}{:>10}".format('phase', 'n', 'mean', 'p95', 'max'))
+            for phase, st in stats.items():
+                lines.append("#   {:<16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                             phase, st['n'], st['mean'], st['p95'], st['max']))
+        return "\n".join(lines) + "\n"
+
+
+class profiler():
+    """Times calls to experiment functions, and optionally profiles them
+
+        Each function is wrapped (see wrap) so that every call is timed, and 
+        the number of calls, and total, mean and max durations are recorded 
+        per function. modes is a list that can also include 'cprofile', to 
+        collect cProfile stats over all of the wrapped calls, and 
+        'tracemalloc', to record the net and peak memory allocated by each 
+        call (with python 3.4+; peak needs 3.9+). 
+
+        cProfile and tracemalloc only see calls made on the main thread, 
+        and not calls to wrapped functions from other wrapped functions; 
+        those are timed only.
+    """
+    def __init__(self, modes):
+        self.modes = modes
+        self.stats = collections.OrderedDict()
+        self.depth = 0
+        self.lock = threading.Lock()
+        self.profile = None
+        self.tracemalloc = None
+        if 'cprofile' in modes:
+            import cProfile
+            self.profile = cProfile.Profile()
+        if 'tracemalloc' in modes:
+            try:
+                import tracemalloc
+            except ImportError:
+                pass
+            else:
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+
+    def wrap(self, func, label):
+        """Returns func, wrapped so that calls are recorded under label
+        """
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            return self.call(label, func, args, kwargs)
+        return wrapped
+
+    def call(self, label, func, args, kwargs):
+        main = isinstance(threading.current_thread(), threading._MainThread)
+        outer = main and self.depth == 0
+        if main:
+            self.depth += 1
+        mem = None
+        if outer and self.tracemalloc is not None:
+            mem = self.tracemalloc.get_traced_memory()[0]
+            if hasattr(self.tracemalloc, 'reset_peak'):
+                self.tracemalloc.reset_peak()
+        if outer and self.profile is not None:
+            self.profile.enable()
+        t0 = _ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            ns = _ns() - t0
+            if outer and self.profile is not None:
+                self.profile.disable()
+            if mem is not None:
+                current, peak = self.tracemalloc.get_traced_memory()
+                mem = (current - mem, peak - mem)
+            if main:
+                self.depth -= 1
+            self.add(label, ns, mem)
+
+    def add(self, label, ns, mem=None):
+        with self.lock:
+            st = self.stats.get(label)
+            if st is None:
+                st = self.stats[label] = {'calls': 0, 'total': 0, 'max': 0, 'net': 0, 'peak': 0, 'mem_calls': 0}
+            st['calls'] += 1
+            st['total'] += ns
+            st['max'] = max(st['max'], ns)
+            if mem is not None:
+                st['mem_calls'] += 1
+                st['net'] += mem[0]
+                st['peak'] = max(st['peak'], mem[1])
+
+    def report(self, ncalls=25):
+        """Returns a table of the per-function stats, slowest (total) first, 
+            and the top ncalls functions by cumulative time from cProfile, as 
+            comments
+        """
+        lines = ["# Profile (ms)"]
+        header = "#   {:<40}{:>8}{:>12}{:>10}{:>10}".format('function', 'calls', 'total', 'mean', 'max')
+        if self.tracemalloc is not None:
+            header += "{:>14}{:>14}".format('mean net KB', 'max peak KB')
+        lines.append(header)
+        stats = sorted(self.stats.items(), key=lambda item: item[1]['total'], reverse=True)
+        for label, st in stats:
+            line = "#   {:<40}{:>8}{:>12.3f}{:>10.3f}{:>10.3f}".format(label, st['calls'], 
+                    st['total']/1e6, st['total']/1e6/st['calls'], st['max']/1e6)
+            if self.tracemalloc is not None:
+                if st['mem_calls']:
+                    line += "{:>14.1f}{:>14.1f}".format(st['net']/1024./st['mem_calls'], st['peak']/1024.)
+                else:
+                    line += "{:>14}{:>14}".format('-', '-')
+            lines.append(line)
+        if self.profile is not None:
+            import pstats
+            out = StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(ncalls)
+            lines.append("# cProfile, by cumulative time:")
+            lines.extend("# " + line for line in out.getvalue().strip('\n').split('\n'))
+        return "\n".join(lines) + "\n"
+
+    def stop(self):
+        if self.tracemalloc is not None and self.tracemalloc.is_tracing():
+            self.tracemalloc.stop()
+
+
+def _func_label(f):
+    module = getattr(f, '__module__', None) or ''
+    return "{}.{}".format(module.split('.')[-1], getattr(f, '__name__', repr(f)))
+
+def profile_functions(exp):
+    """Wraps the experiment's event functions, and its present_trial, 
+        prompt_response, prompt_condition and generate_stimulus functions, 
+        with a profiler (exp.run.profiler), according to exp.profile
+    """
+    exp.run.profiler = p = profiler(exp.profile)
+    for event in exp.eventTypes:
+        thisstr = "{}_".format(event)
+        funcs = getattr(exp, thisstr)
+        setattr(exp, thisstr, [p.wrap(f, "{}: {}".format(event, _func_label(f))) for f in funcs])
+    for name in ['present_trial', 'prompt_response', 'prompt_condition', 'generate_stimulus']:
+        f = getattr(exp, name, None)
+        if f is not None:
+            setattr(exp, name, p.wrap(f, "{}: {}".format(name, _func_label(f))))
+
+def write_profile_report(exp):
+    """Writes the profiler's report (see profiler) to the console and/or log 
+        file, and saves the cProfile stats to exp.profileFile, if set
+    """
+    p = exp.run.profiler
+    if p is not None:
+        report = p.report()
+        if exp.logConsole:
+            print(report)
+        if exp.logFile:
+            write_data(report, exp.logFile)
+        if exp.profileFile and p.profile is not None:
+            p.profile.dump_stats(exp.profileFile)
+        p.stop()
+
+
+class _timed():
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+
+    def __enter__(self):
+        self.t0 = _ns()
+
+    def __exit__(self, *args):
+        self.timer.add(self.phase, _ns() - self.t0)
+
+def write_timing_report(exp):
+    """Writes the session's timing report (see trial_timer) to the console 
+        and/or log file
+    """
+    if exp.timingReport and exp.run.timer is not None:
+        report = exp.run.timer.report()
+        if exp.logConsole:
+            print(report)
+        if exp.logFile:
+            write_data(report, exp.logFile)
+
+
+class trial_table():
+    """Writes a typed row per event to an sqlite database
+
+        This is an alternative to parsing the text data file: each event is 
+        written as a row of the table 'events', with columns for the session, 
+        event, timestamp, experiment name, host, subject, block, blocks, 
+        condition, trial_block, trial and response, plus a column for each 
+        variable (named var_<name>) and each dynamic value (dyn_<name>). 
+        Columns are added as new variables appear, with a type taken from the 
+        first value seen that isn't None (so numeric levels are stored as 
+        numbers). 
+        Non-scalar values are stored as JSON text. Sessions can be appended to 
+        the same file, and are distinguished by the session column (the time 
+        the table was opened). 
+
+        Rows are committed by commit, which gustav calls at the start of the 
+        experiment and at the end of each block, and by close. Use 
+        psylab.tools.data_tools.read_trial_table to read the data back.
+
+        Set exp.dataTable to the filename (which can contain $-variables, as 
+        with exp.dataFile) to use it.
+    """
+    columns = collections.OrderedDict([
+                ('session', 'TEXT'), ('event', 'TEXT'), ('timestamp', 'REAL'), 
+                ('experiment', 'TEXT'), ('host', 'TEXT'), ('subject', 'TEXT'), 
+                ('block', 'INTEGER'), ('blocks', 'INTEGER'), ('condition', 'INTEGER'), 
+                ('trial_block', 'INTEGER'), ('trial', 'INTEGER'), ('response', 'TEXT'),
+              ])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.session = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS events ({})'.format(
+            ', '.join('"{}" {}'.format(k, v) for k, v in self.columns.items())))
+        self.names = set(row[1] for row in self.db.execute('PRAGMA table_info(events)'))
+        self.inserts = {}
+        atexit.register(self.close)
+
+    def _add_column(self, name, value):
+        if isinstance(value, (bool, int, np.integer)):
+            t = 'INTEGER'
+        elif isinstance(value, (float, np.floating)) or _is_number(value):
+            t = 'REAL'
+        else:
+            t = 'TEXT'
+        self.db.execute('ALTER TABLE events ADD COLUMN "{}" {}'.format(name, t))
+        self.names.add(name)
+
+    def write(self, exp, event):
+        row = collections.OrderedDict([
+                ('session', self.session), ('event', event), ('timestamp', time.time()),
+                ('experiment', exp.name), ('host', exp.host), ('subject', exp.subjID),
+                ('block', exp.run.block+1), ('blocks', exp.run.nblocks), 
+                ('condition', exp.run.condition+1), ('trial_block', exp.run.trials_block+1), 
+                ('trial', exp.run.trials_exp+1), ('response', _table_value(exp.run.response)),
+              ])
+        for prefix, vals in [('var_', exp.var.current), ('dyn_', exp.var.dynamic)]:
+            for k, v in vals.items():
+                row[prefix + re.sub(r'\W', '_', str(k))] = _table_value(v)
+        for name, value in list(row.items()):
+            if name not in self.names:
+                if value is None:
+                    # Leave it NULL until there is a value to take the column 
+                    # type from
+                    del row[name]
+                else:
+                    self._add_column(name, value)
+        names = tuple(row.keys())
+        sql = self.inserts.get(names)
+        if sql is None:
+            sql = 'INSERT INTO events ({}) VALUES ({})'.format(
+                ', '.join('"{}"'.format(n) for n in names), ', '.join('?'*len(names)))
+            self.inserts[names] = sql
+        self.db.execute(sql, tuple(row.values()))
+
+    def commit(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def _table_value(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if v is None or isinstance(v, (bool, int, float, str, type(u''))):
+        return v
+    if isinstance(v, np.ndarray):
+        v = v.tolist()
+    return json.dumps(v, default=str)
+
+def close_table(exp):
+    """Commits and closes the trial table, if there is one
+    """
+    if exp.run.table is not None:
+        exp.run.table.close()
+        exp.run.table = None
+
+
+class _worker():
+    """Runs a function on a background thread, and holds on to its result
+    """
+    def __init__(self, func, *args):
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(func, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, args):
+        try:
+            self.result = func(*args)
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        """Waits for the function to finish, and returns its result
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def get_stimulus(exp):
+    """Sets exp.stim.buffer to the stimulus for the current trial
+
+        If the experiment file has a generate_stimulus(exp, trial, current) 
+        function, gustav calls it after pre_trial, and puts what it returns 
+        in exp.stim.buffer for present_trial to use. trial is the trial 
+        number within the block (exp.run.trials_block), and current is a 
+        copy of the condition's variables (exp.var.current).
+
+        If exp.prefetch is True, the stimulus for the next trial is generated 
+        on a background thread while the subject responds to the current one, 
+        so that heavy processing doesn't lengthen the inter-trial interval. 
+        This only happens when the method says that the next trial doesn't 
+        depend on the response (via its prefetch_next function). Otherwise 
+        (eg., adaptive tracks), or at the start of a block, the stimulus is 
+        generated here, as usual.
+
+        A prefetched stimulus is generated before the next trial's pre_trial 
+        has run, at the same time as the main thread is running the current 
+        trial's events. trial and current are taken for the next trial when 
+        the prefetch is queued, so generate_stimulus must build the stimulus 
+        from them (and from settings that don't change during the block), 
+        and must not read or write mutable exp state, such as exp.stim, 
+        exp.run, or anything that pre_trial or post_trial sets. Per-trial 
+        randomization, for example, should be derived from trial inside 
+        generate_stimulus, not set up in pre_trial.
+
+        If the stimuli for the block were precomputed (see precompute_block), 
+        the precomputed stimulus is used instead.
+    """
+    store = exp.run.block_store
+    if store is not None and store.has(exp.run.trials_block):
+        if exp.run.trials_block in store.store:
+            exp.stim.buffer = store.get(exp.run.trials_block)
+        else:
+            t0 = time.time()
+            exp.stim.buffer = store.get(exp.run.trials_block)
+            log(exp, "Precomputed {} more stimuli for block $block in {:.2f} s ({:.1f} MB)\n".format(
+                    len(store.store)+1, time.time()-t0, store.nbytes/1048576.))
+        return
+    if exp.generate_stimulus is None:
+        return
+    if exp.run.prefetched is not None:
+        worker = exp.run.prefetched
+        exp.run.prefetched = None
+        exp.stim.buffer = worker.get()
+        debug(exp, "Got prefetched stimulus")
+    else:
+        exp.stim.buffer = exp.generate_stimulus(exp, exp.run.trials_block, 
+                                                copy.deepcopy(exp.var.current))
+
+
+def prefetch_stimulus(exp):
+    """Starts generating the next trial's stimulus, if possible (see get_stimulus)
+    """
+    if (exp.prefetch and exp.generate_stimulus is not None and exp.run.prefetched is None 
+            and exp.run.block_store is None):
+        prefetch_next = getattr(exp.method, 'prefetch_next', None)
+        if prefetch_next is not None and prefetch_next(exp):
+            # Snapshot the next trial's condition now, rather than letting the 
+            # worker read exp while the main thread changes it
+            exp.run.prefetched = _worker(exp.generate_stimulus, exp, exp.run.trials_block+1, 
+                                         copy.deepcopy(exp.var.current))
+            debug(exp, "Prefetching next stimulus")
+
+
+def discard_prefetched(exp):
+    """Waits for, and discards, a stimulus that was prefetched but not used, 
+        and any stimuli precomputed for the block
+    """
+    if exp.run.prefetched is not None:
+        worker = exp.run.prefetched
+        exp.run.prefetched = None
+        worker.thread.join()
+        debug(exp, "Discarded prefetched stimulus")
+    if exp.run.block_store is not None:
+        exp.run.block_store = None
+        debug(exp, "Discarded precomputed stimuli")
+
+
+class block_store():
+    """Holds the precomputed stimuli for a block, bounded by total size in bytes
+
+        Stimuli are built in parallel, a pool-sized batch at a time, until the 
+        store is (about to be) full. Stimuli are removed as they are used, and 
+        when the store runs out, the next lot is built.
+    """
+    def __init__(self, pool, build, trial_args, maxbytes=512*1024*1024, processes=1):
+        self.pool = pool
+        self.build = build
+        self.pending = collections.OrderedDict(trial_args)
+        self.store = collections.OrderedDict()
+        self.maxbytes = maxbytes
+        self.batch = max(1, processes)
+        self.nbytes = 0
+        self.item_bytes = 0
+
+    def has(self, trial):
+        return trial in self.store or trial in self.pending
+
+    def fill(self):
+        """Builds stimuli until the store is full. Returns the number built
+        """
+        n = 0
+        while len(self.pending) > 0:
+            batch = min(self.batch, len(self.pending))
+            if n > 0 and self.nbytes + batch*self.item_bytes > self.maxbytes:
+                break
+            trials = list(self.pending.keys())[:batch]
+            args = [self.pending.pop(t) for t in trials]
+            for t,stim in zip(trials, self.pool.map(self.build, args)):
+                self.store[t] = stim
+                self.nbytes += _nbytes(stim)
+            n += batch
+            self.item_bytes = self.nbytes / float(len(self.store))
+        return n
+
+    def get(self, trial):
+        if trial not in self.store:
+            # Anything built before this trial won't be used
+            for t in list(self.store.keys()):
+                self.nbytes -= _nbytes(self.store.pop(t))
+            self.fill()
+        stim = self.store.pop(trial)
+        self.nbytes -= _nbytes(stim)
+        return stim
+
+
+def _nbytes(obj):
+    """Returns the size of an array, or the total size of a list/tuple of arrays
+    """
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    return getattr(obj, 'nbytes', 0)
+
+
+def precompute_block(exp, trials, processes=None, maxbytes=512*1024*1024):
+    """Builds the stimuli for a block in parallel, using a process pool
+
+        Called by methods (eg., constant) in pre_block when every trial of the 
+        block is known in advance. The experiment file must define two 
+        functions:
+
+        stimulus_args(exp, trial) is called (in the main process) for each 
+        trial, and returns whatever build_stimulus needs, which must be 
+        picklable (eg., filenames and parameter values, but not exp).
+
+        build_stimulus(args) is called in the worker processes, and returns 
+        the stimulus. It must be a module-level function.
+
+        The stimuli are kept in exp.run.block_store, bounded by maxbytes, and 
+        are put into exp.stim.buffer trial by trial (see get_stimulus). The 
+        time taken to build them is written to the log.
+    """
+    stimulus_args = getattr(exp.experiment, 'stimulus_args', None)
+    build_stimulus = getattr(exp.experiment, 'build_stimulus', None)
+    if stimulus_args is None or build_stimulus is None:
+        raise Exception("To precompute stimuli, the experiment file must define stimulus_args(exp, trial) and build_stimulus(args)")
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if exp.run.pool is None:
+        exp.run.pool = multiprocessing.Pool(processes)
+        debug(exp, "Started stimulus pool: {} processes".format(processes))
+    trial_args = [(t, stimulus_args(exp, t)) for t in trials]
+    exp.run.block_store = block_store(exp.run.pool, build_stimulus, trial_args, maxbytes, processes)
+    t0 = time.time()
+    n = exp.run.block_store.fill()
+    log(exp, "Precomputed {} of {} stimuli for block $block in {:.2f} s ({:.1f} MB)\n".format(
+            n, len(trial_args), time.time()-t0, exp.run.block_store.nbytes/1048576.))
+
+
+def close_pool(exp):
+    """Shuts down the process pool used to precompute stimuli, if any
+    """
+    if exp.run.pool is not None:
+        exp.run.pool.close()
+        exp.run.pool.join()
+        exp.run.pool = None
+        debug(exp, "Closed stimulus pool")
+
+
+class stim_cache():
+    """A cache for stimulus audio, bounded by total size in bytes
+
+        Stimuli are loaded (and optionally processed) the first time they are 
+        requested, and kept in memory so that repeated tokens do not need to 
+        be read from disk or processed again. Entries are keyed by file path, 
+        file modification time, and a hash of the processing function and its 
+        parameters. When the total size exceeds maxbytes, the least recently 
+        used entries are dropped. Hits and misses are written to the debug log.
+
+        Gustav creates one of these as exp.stimCache, with maxbytes set by 
+        exp.stimCacheSize.
+
+        Parameters
+        ----------
+        exp : gustav exp
+            The experiment, for debug logging
+        maxbytes : int
+            The maximum total size of the cached arrays
+        loader : function
+            A function that takes a filename and returns (data, fs). 
+            [default = psylab.signal.waveio.wavread]
+
+        Example
+        -------
+        def pre_trial(exp):
+            f = exp.stim.files.get_filenames()[0]
+            exp.stim.target, fs = exp.stimCache.get(f, psylab.signal.vocoder, 
+                                   channels=8, inlo=100, inhi=8000)
+
+        Notes
+        -----
+        The arrays returned are read-only, since they are shared by every 
+        request for that stimulus. Use .copy() if you need to modify one in 
+        place.
+    """
+    def __init__(self, exp, maxbytes=256*1024*1024, loader=None):
+        self.exp = exp
+        self.maxbytes = maxbytes
+        if loader is None:
+            from ..signal.waveio import wavread
+            loader = wavread
+        self.loader = loader
+        self.clear()
+
+    def clear(self):
+        self._cache = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, process=None, **params):
+        """Returns (data, fs) for a soundfile
+
+            Parameters
+            ----------
+            filename : str
+                The soundfile to load
+            process : function
+                A function to apply to the data, called as 
+                process(data, fs, **params). It should return the processed 
+                data. [default = None]
+            params : 
+                Any further keyword arguments are passed to process, and are 
+                part of the cache key.
+        """
+        filename = os.path.abspath(filename)
+        key = (filename, os.path.getmtime(filename), _hash_params(process, params))
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._cache.pop(key)
+            self._cache[key] = entry
+            self._debug("hit", filename)
+            return entry
+        self.misses += 1
+        data, fs = self.loader(filename)
+        if process is not None:
+            data = process(data, fs, **params)
+        data = np.asarray(data)
+        data.setflags(write=False)
+        entry = (data, fs)
+        if data.nbytes <= self.maxbytes:
+            self._cache[key] = entry
+            self.nbytes += data.nbytes
+            while self.nbytes > self.maxbytes:
+                k, (d, f) = self._cache.popitem(last=False)
+                self.nbytes -= d.nbytes
+        self._debug("miss", filename)
+        return entry
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache),
+                'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+    def _debug(self, what, filename):
+        debug(self.exp, "Stim cache {}: {} [hits: {}, misses: {}, {:.1f} of {:.1f} MB]".format(
+                what, filename, self.hits, self.misses, self.nbytes/1048576., self.maxbytes/1048576.))
+
+
+def _hash_params(process, params):
+    """Returns a hash of a processing function and its parameters, for use as 
+        part of a cache key. Arrays are hashed by content
+    """
+    if process is None:
+        return None
+    h = hashlib.sha1()
+    _hash_function(h, process)
+    for k in sorted(params):
+        h.update(str(k).encode('utf-8'))
+        _hash_value(h, params[k])
+    return h.hexdigest()
+
+def _hash_function(h, func):
+    """Adds a function's identity to a hash: its qualified name, bytecode, 
+        constants and closure contents, so that different lambdas (or 
+        closures with different values) don't collide. Callables without 
+        code (eg., builtins) are identified by id
+    """
+    f = getattr(func, '__func__', func)
+    name = getattr(f, '__qualname__', getattr(f, '__name__', repr(f)))
+    h.update("{}.{}".format(getattr(f, '__module__', ''), name).encode('utf-8'))
+    code = getattr(f, '__code__', None)
+    if code is None:
+        h.update(str(id(func)).encode('utf-8'))
+        return
+    h.update(code.co_code)
+    h.update(repr(code.co_consts).encode('utf-8'))
+    for cell in getattr(f, '__closure__', None) or ():
+        try:
+            _hash_value(h, cell.cell_contents)
+        except ValueError:  # Empty cell
+            pass
+    if getattr(func, '__self__', None) is not None:
+        h.update(str(id(func.__self__)).encode('utf-8'))
+
+def _hash_value(h, v):
+    if isinstance(v, np.ndarray):
+        h.update("{}{}".format(v.dtype, v.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(v).tobytes())
+    else:
+        h.update(repr(v).encode('utf-8'))
+
+
 def get_frontend(exp, frontend):
     """Tries to load the specified frontend
     """
@@ -607,84 +1580,142 @@ def get_expanded_vals_in_string(instr, exp):
                             instead of values (eg., for datafile header). 
         $user[varname]   : The value of a user variable
         $stim[varname]   : The value of a stim variable
+        $timing[phase]   : How long phase (eg., present_trial) last took, in 
+                            ms. Use $timing[phase.stat] for a stat for the 
+                            current block: n, mean, p95, max (see trial_timer)
+
+        Each string is parsed once into literal text and variable references 
+        (see compile_template), and the result is cached, so that expanding 
+        it again is a single pass over the references, however many user and 
+        stim variables there are.
     """
 
-    outstr = instr.replace("$name", exp.name)
-    outstr = outstr.replace("$note", exp.note)
-    outstr = outstr.replace("$comments", "\n# ".join(exp.comments.split('\n')) )
-    outstr = outstr.replace("$host", exp.host)
-    outstr = outstr.replace("$subj", exp.subjID)
-    outstr = outstr.replace("$trial_block", str(exp.run.trials_block+1))
-    outstr = outstr.replace("$trial", str(exp.run.trials_exp+1))
-    outstr = outstr.replace("$blocks", str(exp.run.nblocks))
-    outstr = outstr.replace("$block", str(exp.run.block+1))
-    outstr = outstr.replace("$conditions", str(exp.var.nlevels_total))
-    outstr = outstr.replace("$condition", str(exp.run.condition+1))
-    outstr = outstr.replace("$time", exp.run.time)
-    outstr = outstr.replace("$date", exp.run.date)
-    outstr = outstr.replace("$response", exp.run.response)
-
-    # This func gets called from setup (for datafilename), and exp.var.current is not set at that point
-    if len(exp.var.current)>0:
-        currentvars = []
-        currentvarsvals = []
-        for key, val in exp.var.current.iteritems():
-            currentvars.append(val)
-            currentvarsvals.append("{} = {}".format(key, val))
-            outstr = outstr.replace("$var[{}]".format(key), val)
-
-        got_cv = True
-        while got_cv:
-            expr, delim = get_arg(outstr,"$currentvarsvals")
-            if expr != "":
-                if delim == "":
-                    delim = ","
-                outstr = outstr.replace(expr, delim.join(currentvarsvals))
+    tokens = _template_cache.get(instr)
+    if tokens is None:
+        tokens = compile_template(instr)
+        _template_cache[instr] = tokens
+        while len(_template_cache) > template_cache_maxsize:
+            _template_cache.popitem(last=False)
+    return render_template(tokens, exp)
+
+
+template_cache_maxsize = 256
+_template_cache = collections.OrderedDict()
+
+# Simple variables. Where one name is a prefix of another, the longer 
+# comes first, so that it matches first
+_template_vars = collections.OrderedDict([
+    ('name',        lambda exp: exp.name),
+    ('note',        lambda exp: exp.note),
+    ('comments',    lambda exp: "\n# ".join(exp.comments.split('\n'))),
+    ('host',        lambda exp: exp.host),
+    ('subj',        lambda exp: exp.subjID),
+    ('trial_block', lambda exp: str(exp.run.trials_block+1)),
+    ('trial',       lambda exp: str(exp.run.trials_exp+1)),
+    ('blocks',      lambda exp: str(exp.run.nblocks)),
+    ('block',       lambda exp: str(exp.run.block+1)),
+    ('conditions',  lambda exp: str(exp.var.nlevels_total)),
+    ('condition',   lambda exp: str(exp.run.condition+1)),
+    ('time',        lambda exp: exp.run.time),
+    ('date',        lambda exp: exp.run.date),
+    ('response',    lambda exp: str(exp.run.response)),
+    ])
+
+# Bracketed variables, eg. $user[varname]. Each takes (exp, arg), and 
+# returns None if there is nothing to replace the reference with
+def _template_currentvars(exp, delim):
+    if len(exp.var.current) > 0:
+        return (delim or ",").join(str(val) for val in exp.var.current.values())
+
+def _template_currentvarsvals(exp, delim):
+    if len(exp.var.current) > 0:
+        return (delim or ",").join("{} = {}".format(key, val) for key, val in exp.var.current.items())
+
+def _template_attr(obj, key, name):
+    if key[:2] != "__" and hasattr(obj, key):
+        if name:
+            return key
+        return str(getattr(obj, key))
+
+def _template_item(d, key, name):
+    if d is not None and key in d:
+        if name:
+            return key
+        return str(d[key])
+
+def _template_timing(exp, key):
+    if exp.run.timer is not None:
+        val = exp.run.timer.get(key)
+        if isinstance(val, int):
+            return str(val)
+        elif val is not None:
+            return "{:.3f}".format(val)
+
+_template_args = {
+    ('$', 'currentvarsvals'): _template_currentvarsvals,
+    ('$', 'currentvars'):     _template_currentvars,
+    ('@', 'currentvars'):     lambda exp, delim: (delim or ",").join(exp.var.varlist),
+    ('$', 'var'):             lambda exp, key: _template_item(exp.var.current, key, False),
+    ('$', 'user'):            lambda exp, key: _template_attr(exp.user, key, False),
+    ('@', 'user'):            lambda exp, key: _template_attr(exp.user, key, True),
+    ('$', 'stim'):            lambda exp, key: _template_attr(exp.stim, key, False),
+    ('@', 'stim'):            lambda exp, key: _template_attr(exp.stim, key, True),
+    ('$', 'dynamic'):         lambda exp, key: _template_item(getattr(exp.var, 'dynamic', None), key, False),
+    ('@', 'dynamic'):         lambda exp, key: _template_item(getattr(exp.var, 'dynamic', None), key, True),
+    ('$', 'timing'):          _template_timing,
+    }
+
+def _template_re():
+    args = sorted(set(name for prefix, name in _template_args), key=len, reverse=True)
+    return re.compile(r"([$@])({})\[([^\]]*)\]|\$({})".format("|".join(args), "|".join(_template_vars)))
+
+_template_pattern = _template_re()
+
+def compile_template(instr):
+    """Parses a string with variable references (see get_expanded_vals_in_string) 
+        into a list of tokens, for render_template
+
+        Each token is either a literal string, or a tuple: (function, arg, 
+        text), where function returns the value of the reference (or None to 
+        leave text as is). 
+    """
+    tokens = []
+    pos = 0
+    for m in _template_pattern.finditer(instr):
+        if m.group(4) is not None:
+            func = _template_vars[m.group(4)]
+            arg = None
+        else:
+            func = _template_args.get((m.group(1), m.group(2)))
+            if func is None:
+                continue
+            arg = m.group(3).strip("\"\'")
+        if m.start() > pos:
+            tokens.append(instr[pos:m.start()])
+        tokens.append((func, arg, m.group(0)))
+        pos = m.end()
+    if pos < len(instr):
+        tokens.append(instr[pos:])
+    return tokens
+
+def render_template(tokens, exp):
+    """Renders a compiled template (see compile_template) in a single pass
+    """
+    out = []
+    for token in tokens:
+        if isinstance(token, tuple):
+            func, arg, text = token
+            if arg is None:
+                val = func(exp)
             else:
-                got_cv = False
-
-        got_cv = True
-        while got_cv:
-            expr, delim = get_arg(outstr,"$currentvars")
-            if expr != "":
-                if delim == "":
-                    delim = ","
-                outstr = outstr.replace(expr, delim.join(currentvars))
+                val = func(exp, arg)
+            if val is None:
+                out.append(text)
             else:
-                got_cv = False
-
-    varlist = []
-    for key in exp.var.varlist:
-        varlist.append(key)
-
-    got_cv = True
-    while got_cv:
-        expr, delim = get_arg(outstr,"@currentvars")
-        if expr != "":
-            if delim == "":
-                delim = ","
-            outstr = outstr.replace(expr, delim.join(varlist))
+                out.append(val)
         else:
-            got_cv = False
-
-    items = getmembers(exp.user)
-    for key, val in items:
-        if key[:2] != "__":
-            outstr = outstr.replace("$user["+str(key)+"]", str(val))
-            outstr = outstr.replace("@user["+str(key)+"]", str(key))
-
-    items = getmembers(exp.stim)
-    for key, val in items:
-        if key[:2] != "__":
-            outstr = outstr.replace("$stim["+str(key)+"]", str(val))
-            outstr = outstr.replace("@stim["+str(key)+"]", str(key))
-
-    if hasattr(exp.var,'dynamic'):
-        for key, val in exp.var.dynamic.items():
-            outstr = outstr.replace("$dynamic["+str(key)+"]", str(val))
-            outstr = outstr.replace("@dynamic["+str(key)+"]", str(key))
-
-    return outstr
+            out.append(token)
+    return "".join(out)
 
 
 def get_arg(instr, var):
@@ -30,8 +30,12 @@ Some are pedagogical in nature, others might actually be useful.
 Functions include:
 
 atten - Attenuates input array by a dB value
+butter - Designs Butterworth filters, caching them for reuse
 compensate - Shapes the input array in the frequency domain
 compress - Applies simple, single-channel compression to input signal signal
+compress_multiband - Applies multi-channel compression to input signal
+Compressor - Applies compression to a signal one block at a time
+Convolver - Partitioned convolution of long or streaming signals with an impulse response
 envelope - Extracts the amplitude envelope from a signal
 equate - Equates wavefiles in rms
 erbs2f - Converts erb numbers to frequency values
@@ -46,6 +50,7 @@ freqs_logspace - Computes a range of frequencies evenly spaced in log space
 gso - Varies the inter-aural correlation of a stereo signal
 hcomplex - Generates harmonic complexes
 hrtf_data - Helper class for handling hrtf data
+HrtfRenderer - Spatializes signals with hrtfs, including moving sources
 ild - Applies an interaural level difference to a signal
 interp - Interpolates a signal to a specified number of points
 itd - Applies an interaural time difference to a signal
@@ -62,6 +67,7 @@ place2f - Converts a basilar membrane place (mm) to a frequency (Hz)
 pre_emphasis - Applies a pre-emphasis filter to a signal
 ramps - Applies ramps to the onsets and/or offsets of a signal
 rir - Generates room impulse responses
+rir_multi - Generates room impulse responses for several receivers and/or sources
 rms - Computes the root-mean-square of a signal
 samp2ms - Converts samples to milliseconds
 sliding_window - Apply a sliding window to a signal for vectorized processing
@@ -71,6 +77,9 @@ specplot - Plots magnitude spectra
 t60 - Estimates reverberation time
 tone - Generates pure tones
 vocoder - Implements an envelope vocoder
+vocoder_fft - Implements an envelope vocoder in the short-time Fourier domain
+VocoderPlan - A precomputed vocoder, for vocoding many signals with the same settings
+vocoder_corpus - Vocodes all wavefiles in a directory, using a pool of processes
 white - Generates white noise
 zeropad - Zero pads the shorter of two or more arrays
 
@@ -86,22 +95,23 @@ from scipy.signal import filter_design as filters, lfilter, filtfilt
 from .atten import atten
 from .binaural import apply_itd, apply_ild, gso
 from .compensate import compensate
-from .compression import compress
+from .compression import compress, compress_multiband, Compressor
+from .convolution import Convolver
 from .envelope import envelope
 from .equate import equate
 from .f0 import f0
-from .filter import freqs_logspace, filter_bank, pre_emphasis
+from .filter import freqs_logspace, filter_bank, pre_emphasis, butter, filter_cache_info, filter_cache_clear
 from .freq_compression import freq_compress
 from .frequency import f2oct, oct2f, f2erbs, erbs2f, place2f, f2place
 from .hcomplex import hcomplex, hcomplex_old
-from .hrtf import convolve, hrtf_data
+from .hrtf import convolve, hrtf_data, HrtfRenderer
 from .interp import interp
 from .mix import mix
 from .noise import pink, white, irn, mls
 from .normalize import normalize
 from .peakpick import pick_peaks
 from .ramps import ramps
-from .rir import rir, fconv
+from .rir import rir, rir_multi, fconv
 from .rms import rms
 from .samp import samp2ms, ms2samp
 from .smooth import smooth
@@ -109,6 +119,6 @@ from .spec import lts, magspec, specgram, specplot
 from .spl import spl2sp, spl2si, sp2spl, si2spl
 from .tone import tone
 from .t60 import t60
-from .vocoder import vocoder, vocoder_vect, vocoder_overlap
+from .vocoder import vocoder, vocoder_vect, vocoder_overlap, vocoder_fft, VocoderPlan, vocoder_corpus
 from .window import sliding_window
 from .zeropad import zeropad
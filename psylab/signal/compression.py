@@ -25,8 +25,228 @@
 #
 
 import numpy as np
+from .filter import filter_bank
 
-def compress(sig, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay_audio=False, make_up=False, return_gain_function=False):
+try:
+    import numba
+except ImportError:
+    numba = None
+
+detector_backends = ['auto', 'numba', 'python', 'reference']
+
+
+def _peak_detector_reference(sig, d, alpha, beta):
+    """The original per-sample peak detector loop, operating in place on d.
+        d[0] holds the detector state preceding sig[1]; sig[0] is ignored.
+    """
+    aConst = (1-alpha)
+    for thisPtr in range( 1, len( sig ) ):
+        prevPtr = thisPtr - 1
+        if ( sig[ thisPtr] < d[prevPtr] ):
+            d[  thisPtr] = d[prevPtr] * beta
+        else:
+            d[  thisPtr] = d[prevPtr] * alpha + ( sig[thisPtr] * aConst )
+    return d
+
+
+def _peak_detector_python(sig, d, alpha, beta):
+    """Same as _peak_detector_reference, but loops over python floats rather
+        than indexing numpy arrays, which is about 2-3 times faster.
+        Only valid for float64 data, where the arithmetic is identical.
+    """
+    alpha = float(alpha)
+    beta = float(beta)
+    aConst = (1-alpha)
+    prev = float(d[0])
+    out = [prev]
+    append = out.append
+    for this in sig[1:].tolist():
+        if this < prev:
+            prev = prev * beta
+        else:
+            prev = prev * alpha + ( this * aConst )
+        append(prev)
+    d[:] = out
+    return d
+
+
+def _peak_detector_2d(sig, d, alpha, beta):
+    """The per-sample peak detector loop for 2-d input (channels along axis 
+        1), for compilation. alpha and beta are arrays with one value per 
+        channel. Memory access is sequential for row-major input.
+    """
+    aConst = (1-alpha)
+    for thisPtr in range( 1, sig.shape[0] ):
+        prevPtr = thisPtr - 1
+        for ch in range( sig.shape[1] ):
+            if ( sig[thisPtr, ch] < d[prevPtr, ch] ):
+                d[thisPtr, ch] = d[prevPtr, ch] * beta[ch]
+            else:
+                d[thisPtr, ch] = d[prevPtr, ch] * alpha[ch] + ( sig[thisPtr, ch] * aConst[ch] )
+    return d
+
+
+def _peak_detector_2d_cols(sig, d, alpha, beta):
+    """As _peak_detector_2d, but runs each channel in turn, so that memory 
+        access is sequential for column-major input (eg., filter_bank output)
+    """
+    aConst = (1-alpha)
+    for ch in range( sig.shape[1] ):
+        for thisPtr in range( 1, sig.shape[0] ):
+            prevPtr = thisPtr - 1
+            if ( sig[thisPtr, ch] < d[prevPtr, ch] ):
+                d[thisPtr, ch] = d[prevPtr, ch] * beta[ch]
+            else:
+                d[thisPtr, ch] = d[prevPtr, ch] * alpha[ch] + ( sig[thisPtr, ch] * aConst[ch] )
+    return d
+
+
+if numba is not None:
+    _peak_detector_numba = numba.njit(_peak_detector_reference)
+    _peak_detector_numba_2d = numba.njit(_peak_detector_2d)
+    _peak_detector_numba_2d_cols = numba.njit(_peak_detector_2d_cols)
+else:
+    _peak_detector_numba = None
+    _peak_detector_numba_2d = None
+    _peak_detector_numba_2d_cols = None
+
+
+def _get_detector_backend(backend, dtype):
+    """Returns the peak detector function to use for the specified backend
+    """
+    if backend not in detector_backends:
+        raise ValueError("backend must be one of {}".format(detector_backends))
+    if backend == 'numba' and numba is None:
+        raise ImportError("The numba backend requires the numba package")
+    if backend in ['auto', 'numba'] and numba is not None:
+        return _peak_detector_numba
+    elif backend in ['auto', 'python'] and dtype == np.float64:
+        return _peak_detector_python
+    else:
+        return _peak_detector_reference
+
+
+def _detector_coefs(fs, attack, release):
+    """Returns the attack and release coefficients, based on the specified
+        attack and release times (corresponding to 1/e time constants of the
+        peak detector)
+    """
+    alpha = np.exp(-1. / ((np.asarray(attack)/1000.)*fs))
+    beta = np.exp(-1. / ((np.asarray(release)/1000.)*fs))
+    return alpha, beta
+
+
+def peak_detector(sig, fs, attack, release, backend='auto', state=None):
+    """Computes the output of an attack/release peak detector
+
+        This is the peak detector used by `compress` (cf Kates 2008, p233).
+        Attack and release time are specified in milliseconds and correspond
+        to the 1/e time constants of the peak detector. Unless state is 
+        specified, the first sample of the peak detector output is zero.
+
+        If sig is 2-d, each column is treated as a channel. With numba, all 
+        channels are processed in a single compiled call; otherwise each 
+        column is run through the 1-d detector in turn. 
+        attack and release can be arrays with one value per channel.
+
+        Parameters
+        ----------
+        sig : array
+            The input signal. Can be 1- or 2-d
+        fs : scalar
+            The sampling frequency
+        attack : scalar or array
+            The attack time constant in ms
+        release : scalar or array
+            The release time constant in ms
+        backend : str
+            The implementation to use. All backends produce identical output:
+            'numba' uses a compiled loop [requires numba]
+            'python' loops over python floats (float64 input only; other
+            dtypes fall back to 'reference')
+            'reference' is the original, slow, numpy loop
+            'auto' uses numba if available, otherwise python [default]
+        state : scalar or array
+            The peak detector output immediately preceding sig[0] (eg., the 
+            last sample of the output for the previous block of a signal). If 
+            specified, the detector runs from this value, and sig[0] is 
+            processed like every other sample. For 2-d input, state can have 
+            one value per channel [default = None]
+
+        Returns
+        -------
+        d : array
+            The peak detector output
+    """
+    sig = np.asarray(sig)
+    if state is not None:
+        # Prepend a dummy sample; the detector ignores the first input sample
+        # and runs from the first output sample, which we set to the state
+        sig = np.concatenate((np.zeros_like(sig[:1]), sig))
+    alpha, beta = _detector_coefs(fs, attack, release)
+    d = np.zeros_like(sig)
+    if state is not None:
+        d[0] = state
+    if sig.ndim == 2:
+        alpha = np.ascontiguousarray(np.broadcast_to(alpha, sig.shape[1:]), dtype=np.float64)
+        beta = np.ascontiguousarray(np.broadcast_to(beta, sig.shape[1:]), dtype=np.float64)
+    elif sig.ndim == 1:
+        alpha = np.float64(alpha)
+        beta = np.float64(beta)
+    else:
+        raise ValueError("sig must be 1- or 2-d")
+    if len(sig) > 1:
+        detector = _get_detector_backend(backend, d.dtype)
+        if sig.ndim == 1:
+            detector(sig, d, alpha, beta)
+        elif detector is _peak_detector_numba:
+            # All channels in a single compiled call, in memory order
+            if sig.flags['F_CONTIGUOUS'] and d.flags['F_CONTIGUOUS']:
+                _peak_detector_numba_2d_cols(sig, d, alpha, beta)
+            else:
+                _peak_detector_numba_2d(sig, d, alpha, beta)
+        else:
+            for ch in range(sig.shape[1]):
+                dch = np.ascontiguousarray(d[:,ch])
+                detector(np.ascontiguousarray(sig[:,ch]), dch, alpha[ch], beta[ch])
+                d[:,ch] = dch
+    if state is not None:
+        d = d[1:]
+    return d
+
+
+def _compression_gain(d, threshold, comp_ratio, ref_spl):
+    """Applies the compression rule to the peak detector output d
+
+        Gain (in dB) is zero where the peak detector output level is below
+        threshold, and compressive above threshold. threshold and comp_ratio
+        can be arrays that broadcast against d (eg., one value per channel).
+    """
+    # Attenuate the rms (.707) of a tone of +-1 v (the loudest possible) by 
+    # the dB difference between the ref_spl, and the threshold spl
+    thresh_peff = 0.70710678118654757 * np.exp((threshold-ref_spl)/8.6860)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # calculate peak detector output level in dB SPL
+        d_dB = threshold + 20.*np.log10(d / thresh_peff)
+
+        # apply the compression rule where the peak detector output is above
+        # threshold; elsewhere the gain is to remain at zero
+        gain = np.where(d_dB > threshold, 
+                        (threshold + (d_dB - threshold) / comp_ratio) - d_dB, 0.)
+    return gain
+
+
+def _make_up_gain(rms_in, rms_out):
+    """Returns the (linear) make-up gain that brings an output with rms 
+        rms_out back to the input rms, rms_in. A silent output gets a gain of 1
+    """
+    if rms_out > 0:
+        return rms_in / rms_out
+    return 1.
+
+
+def compress(sig, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay_audio=False, make_up=False, return_gain_function=False, backend='auto'):
     """Applies simple, single-channel compression to input signal sig in the
         time domain. Optionally returns the gain control signal in addition to
         the compressed signal.   
@@ -88,14 +308,18 @@ def compress(sig, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay
         return_gain_function : bool
             If True, the returned array is the gain control signal
             If False, the returned array is the input signal with gc applied [default]
+        backend : str
+            The peak detector implementation to use: 'auto', 'numba', 'python'
+            or 'reference'. All produce identical gain; see `peak_detector`
+            [default = 'auto']
         
         Returns
         -------
         y : array
             Either the compressed output signal or the sample-by-sample gain 
-            (in dB) applied by the compressor (Note: the effect of the 
-            delay_audio option is not accounted for in the returned gain control 
-            signal)
+            (in dB) applied by the compressor (Note: the effects of the 
+            delay_audio and make_up options are not accounted for in the 
+            returned gain control signal)
 
         Notes
         -----
@@ -103,46 +327,18 @@ def compress(sig, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay
         Research, Nottingham
         
         """
-        
-    # Attenuate the rms (.707) of a tone of +-1 v (the loudest possible) by 
-    # the dB difference between the ref_spl, and the threshold spl
-    thresh_peff = 0.70710678118654757 * np.exp((threshold-ref_spl)/8.6860)
-
-    # calculate attack and release coefficients based on specified attack and
-    # release times (corresponding to 1/e time constants of the peak detector)
-    alpha = np.exp(-1. / ((attack/1000.)*fs))
-    beta = np.exp(-1. / ((release/1000.)*fs))
-    aConst = (1-alpha)
 
     if delay_audio:
-       ndelay = np.round((attack/1000.)*fs/2)
+       ndelay = int(np.round((attack/1000.)*fs/2))
     if make_up:
        sig_rms = np.sqrt(np.mean(sig**2))
 
-    d = np.zeros_like(sig)
-    # loop to calculate peak detector output over the duration of the signal
+    # calculate peak detector output over the duration of the signal
     # (note that first sample of peak detector output is always zero here)
-    for thisPtr in range( 1, len( sig ) ):
-        prevPtr = thisPtr - 1
-        if ( sig[ thisPtr] < d[prevPtr] ):
-            d[  thisPtr] = d[prevPtr] * beta
-        else:
-            d[  thisPtr] = d[prevPtr] * alpha + ( sig[thisPtr] * aConst )
-
-    # calculate peak detector output level in dB SPL
-    d_dB = threshold + 20.*np.log10(d / thresh_peff)
+    d = peak_detector(sig, fs, attack, release, backend=backend)
 
     # calculate gain using a simple compression rule
-    gain = np.zeros_like(d_dB)   # set gain to zero throughout as a first step.  
-                                 # If the peak detector output level is below
-                                 # the compression threshold, the gain is to
-                                 # remain at zero for that sample 
-
-    # find where the peak detector output is above threshold
-    idx = np.where(d_dB > threshold)[0]
-    
-    # apply the compression rule to give the gain to be applied at these samples
-    gain[idx] = (threshold + (d_dB[idx] - threshold) / comp_ratio) - d_dB[idx]
+    gain = _compression_gain(d, threshold, comp_ratio, ref_spl)
     
     if return_gain_function:
         return gain
@@ -157,13 +353,226 @@ def compress(sig, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay
 
     # apply make-up gain if required
     if make_up:
-       make_up_gain = sig_rms - np.sqrt(np.mean(sigout**2))
+       make_up_gain = _make_up_gain(sig_rms, np.sqrt(np.mean(sigout**2)))
        sigout = sigout*make_up_gain
-       gain +=make_up_gain
     
     return sigout
 
 
+def compress_multiband(sig, fs, cfs, threshold, comp_ratio, attack, release, ref_spl=110, order=3, delay_audio=False, make_up=False, return_gain_function=False, sumchannels=True, backend='auto'):
+    """Applies multi-channel (wide dynamic range) compression to input signal
+
+        The signal is split into bands with `filter_bank`, each band is 
+        compressed using the same peak detector and compression rule as 
+        `compress`, and the bands are summed.
+
+        threshold, comp_ratio, attack and release can each be either a scalar, 
+        which is used for every band, or an array with one value per band.
+
+        If delay_audio is true, the audio in each band is delayed by half of 
+        that band's attack time (see `compress`).
+
+        If the make_up option is true, make-up gain is applied automatically
+        such that the rms level of each compressed band is equal to that of 
+        the corresponding input band.
+
+        Parameters
+        ----------
+        sig : array
+            The input signal to be compressed (mono)
+        fs : scalar
+            The sampling frequency
+        cfs : array
+            The band edge frequencies. cfs[:-1] are used as highpass cutoffs
+            and cfs[1:] as lowpass cutoffs (see `filter_bank`); eg., use 
+            `freqs_logspace` to compute them
+        threshold : scalar or array
+            The compression threshold (ie lower kneepoint) in dB SPL
+        comp_ratio : scalar or array
+            The compression ratio (eg a value of 2 gives 2:1 compression
+            above the compression threshold)
+        attack : scalar or array
+            The attack time constant in ms (see `compress`)
+        release : scalar or array
+            The release time constant in ms (see `compress`)
+        ref_spl : scalar
+            The measured SPL, in dB, of a tone at 1 v peak-to-peak. This is 
+            used as the reference for compression threshold
+        order : scalar
+            The order of the band filters [default = 3]
+        delay_audio : bool
+            if true, audio signal is delayed by half the attack time 
+            [default = False]
+        make_up : bool
+            If true, make-up gain is applied [default = False]
+        return_gain_function : bool
+            If True, the returned array is the gain control signal of each band
+            If False, the returned array is the compressed signal [default]
+        sumchannels : bool
+            If True, the compressed bands are summed [default]
+            If False, a 2-d array is returned in which each band is a column
+        backend : str
+            The peak detector implementation to use. See `peak_detector`
+            [default = 'auto']
+
+        Returns
+        -------
+        y : array
+            Either the compressed output signal or the sample-by-sample gain 
+            (in dB, 2-d with one column per band) applied by the compressor
+            (as with `compress`, without delay_audio or make_up)
+    """
+    cfs = np.asarray(cfs, dtype=np.float64)
+    nbands = cfs.size - 1
+    sig = np.asarray(sig, dtype=np.float64)
+
+    # filter_bank output is column-major, so each band is contiguous
+    bands = np.asfortranarray(filter_bank(sig, fs, order, cfs).reshape(-1, nbands))
+
+    threshold = np.broadcast_to(threshold, (nbands,))
+    comp_ratio = np.broadcast_to(comp_ratio, (nbands,))
+    attack = np.broadcast_to(attack, (nbands,))
+    release = np.broadcast_to(release, (nbands,))
+
+    # The detectors of all bands run together (in a single compiled call, 
+    # with numba; see peak_detector). The rest is done one band at a time 
+    # (rows of the transposed arrays), exactly as `compress` would
+    ds = peak_detector(bands, fs, attack, release, backend=backend).T
+    bands = bands.T
+
+    if return_gain_function:
+        gains = np.empty_like(bands)
+    elif sumchannels:
+        sigout = np.zeros(bands.shape[1])
+    else:
+        sigout = np.empty(bands.shape[::-1])
+
+    for i, band in enumerate(bands):
+        gain = _compression_gain(ds[i], threshold[i], comp_ratio[i], ref_spl)
+        if return_gain_function:
+            gains[i] = gain
+            continue
+
+        out = band
+        if delay_audio:
+            ndelay = int(np.round((attack[i]/1000.)*fs/2))
+            if ndelay > 0:
+                out = np.concatenate((np.zeros(ndelay), band[:-ndelay]))
+        out = out * 10.**(gain/20.)
+
+        if make_up:
+            out *= _make_up_gain(np.sqrt(np.mean(band**2)), np.sqrt(np.mean(out**2)))
+
+        if sumchannels:
+            sigout += out
+        else:
+            sigout[:,i] = out
+
+    if return_gain_function:
+        return gains.T
+    return sigout
+
+
+class Compressor():
+    """A stateful, block-based version of `compress`
+
+        Applies the same single-channel compression as `compress`, but to a 
+        signal that is supplied one block at a time (eg., live audio, or a 
+        recording too long to hold in memory). The peak detector state, the 
+        contents of the audio delay line (when delay_audio is True) and the 
+        make-up gain (when make_up is True) are carried across blocks.
+
+        The parameters are the same as for `compress`. When the blocks are 
+        concatenated, the output is identical to that of `compress` on the 
+        whole signal, with two exceptions: with delay_audio, the last 
+        ndelay samples are held in the delay line until the next block 
+        (rather than being truncated); and with make_up, the make-up gain 
+        for each block is based on the rms of the signal so far, since the 
+        rms of the whole signal is not yet known. By the final block, it
+        converges on the one `compress` would apply.
+
+        Example
+        -------
+        c = Compressor(fs, 60, 3, 5, 50)
+        for block in blocks:
+            out = c.process(block)
+    """
+    def __init__(self, fs, threshold, comp_ratio, attack, release, ref_spl=110, delay_audio=False, make_up=False, return_gain_function=False, backend='auto'):
+        self.fs = fs
+        self.threshold = threshold
+        self.comp_ratio = comp_ratio
+        self.attack = attack
+        self.release = release
+        self.ref_spl = ref_spl
+        self.delay_audio = delay_audio
+        self.make_up = make_up
+        self.return_gain_function = return_gain_function
+        self.backend = backend
+        if delay_audio:
+            self.ndelay = int(np.round((attack/1000.)*fs/2))
+        else:
+            self.ndelay = 0
+        self.reset()
+
+    def reset(self):
+        """Clears the detector state, delay line and make-up gain, so that the 
+            next block is treated as the start of a new signal
+        """
+        self.state = None
+        self.delay_line = np.zeros(self.ndelay)
+        self.sum_sq_in = 0.
+        self.sum_sq_out = 0.
+        self.n_samples = 0
+        self.make_up_gain = 1.
+
+    def process(self, block):
+        """Compresses the next block of the signal
+
+            Parameters
+            ----------
+            block : array
+                The next block of the input signal (mono)
+
+            Returns
+            -------
+            y : array
+                Either the compressed block or the sample-by-sample gain 
+                (in dB) applied to it, depending on return_gain_function
+        """
+        block = np.asarray(block)
+        if block.size == 0:
+            return block.copy()
+
+        if self.state is None:
+            # First sample of peak detector output is always zero
+            d = peak_detector(block, self.fs, self.attack, self.release, backend=self.backend)
+        else:
+            d = peak_detector(block, self.fs, self.attack, self.release, backend=self.backend, state=self.state)
+        self.state = d[-1]
+
+        gain = _compression_gain(d, self.threshold, self.comp_ratio, self.ref_spl)
+
+        if self.return_gain_function:
+            return gain
+
+        sig = block
+        if self.ndelay > 0:
+            buf = np.concatenate((self.delay_line, block))
+            sig = buf[:block.size]
+            self.delay_line = buf[block.size:]
+
+        sigout = sig * (10.**(gain/20.))
+
+        if self.make_up:
+            self.sum_sq_in += np.sum(block**2)
+            self.sum_sq_out += np.sum(sigout**2)
+            self.n_samples += block.size
+            self.make_up_gain = _make_up_gain(np.sqrt(self.sum_sq_in/self.n_samples), np.sqrt(self.sum_sq_out/self.n_samples))
+            sigout = sigout*self.make_up_gain
+
+        return sigout
+
+
 def compression_apply(signal, gain):
     """Applies a predetermined gain function to the input signal. `gain`
         should have been generated previously using the `compress` function.
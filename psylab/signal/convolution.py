@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2014 Christopher Brown
+#
+# This file is part of Psylab.
+#
+# Psylab is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Psylab is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Psylab.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Bug reports, bug fixes, suggestions, enhancements, or other
+# contributions are welcome. Go to http://code.google.com/p/psylab/
+# for more information and to contribute. Or send an e-mail to:
+# cbrown1@pitt.edu.
+#
+
+import numpy as np
+
+class Convolver():
+    """A partitioned convolution engine for long impulse responses
+
+        The impulse response is split into partitions of block_size samples,
+        and the spectrum of each partition is computed once. The input is
+        processed block_size samples at a time (uniform-partitioned
+        overlap-save), so memory use is proportional to the length of the
+        impulse response rather than that of the input, and the input can
+        be supplied as a stream.
+
+        As with `convolve`, if either x or h is 2-d, each column is treated
+        as a channel. h can be 1-d, in which case the same h is applied to
+        each channel of x; or x can be 1-d, in which case it is convolved
+        with each channel of h; or both can be 2-d with the same number of
+        channels.
+
+        Parameters
+        ----------
+        h : array
+            The impulse response. Can be 1- or 2-d
+        block_size : int
+            The partition size, in samples. Larger blocks are more efficient
+            for offline use; smaller blocks reduce latency when streaming.
+            [default = 4096]
+
+        Notes
+        -----
+        Unlike `convolve`, the output is not rescaled to the peak of the
+        input; it is the true convolution of x with h.
+
+        Approximate run times, 1 channel, fs = 44100:
+
+            x      h     convolve   Convolver
+            10 s   1 s   0.12 s     0.05 s
+            60 s   2 s   0.99 s     0.34 s
+
+        Example
+        -------
+        # Offline
+        y = Convolver(h).convolve(x)
+
+        # Streaming
+        c = Convolver(h, block_size=512)
+        for block in blocks:
+            out = c.process(block)
+        tail = c.flush()
+    """
+    def __init__(self, h, block_size=4096):
+        h = np.asarray(h, dtype=float)
+        self.h_1d = h.ndim == 1
+        if self.h_1d:
+            h = h[:,np.newaxis]
+        self.h_len = h.shape[0]
+        self.block_size = int(block_size)
+        b = self.block_size
+        self.n_parts = int(np.ceil(self.h_len / float(b)))
+        h = np.concatenate((h, np.zeros((self.n_parts*b-self.h_len, h.shape[1]))))
+        # Spectra of each partition, n_parts x b+1 x channels
+        self.H = np.fft.rfft(h.reshape(self.n_parts, b, h.shape[1]), 2*b, axis=1)
+        self.reset()
+
+    def reset(self):
+        """Clears the input history, so that the next block is treated as the
+            start of a new signal
+        """
+        self.x_1d = None
+        self.buffer = None
+        self.prev = None
+        self.fdl = None
+        self.n_in = 0
+        self.n_out = 0
+
+    def _init_channels(self, x):
+        self.x_1d = x.ndim == 1
+        nx = 1 if self.x_1d else x.shape[1]
+        nh = self.H.shape[2]
+        if nx != nh and nx != 1 and nh != 1:
+            raise ValueError("x and h must have the same number of channels, or one must be 1-d")
+        self.nchannels = max(nx, nh)
+        b = self.block_size
+        self.buffer = np.zeros((0, nx))
+        self.prev = np.zeros((b, nx))
+        # Frequency-domain delay line: spectra of the last n_parts-1 blocks
+        self.fdl = np.zeros((self.n_parts-1, b+1, nx), dtype=complex)
+
+    def _process_blocks(self, x):
+        """Convolves a whole number of blocks, all at once
+        """
+        b = self.block_size
+        nb = x.shape[0] // b
+        frames = np.concatenate((self.prev, x)).reshape(nb+1, b, -1)
+        self.prev = x[-b:]
+        X = np.fft.rfft(np.concatenate((frames[:-1], frames[1:]), axis=1), axis=1)
+        X = np.concatenate((self.fdl, X))
+        Y = np.zeros((nb, b+1, self.nchannels), dtype=complex)
+        p = self.n_parts - 1
+        for k in range(self.n_parts):
+            Y += X[p-k:p-k+nb] * self.H[k]
+        self.fdl = X[nb:]
+        return np.fft.irfft(Y, 2*b, axis=1)[:,b:].reshape(nb*b, self.nchannels)
+
+    def _format(self, y):
+        if self.x_1d and self.h_1d:
+            return y[:,0]
+        else:
+            return y
+
+    def process(self, block):
+        """Convolves the next block of the input signal
+
+            Parameters
+            ----------
+            block : array
+                The next block of the input. Can be any length
+
+            Returns
+            -------
+            y : array
+                The next block of the output. Output is produced block_size
+                samples at a time, so when the length of the input blocks is a
+                multiple of block_size, the output has the same length as the
+                input. Otherwise, left-over samples are held until the next
+                call (or flush).
+        """
+        block = np.asarray(block, dtype=float)
+        if self.buffer is None:
+            self._init_channels(block)
+        if block.ndim == 1:
+            block = block[:,np.newaxis]
+        self.n_in += block.shape[0]
+        x = np.concatenate((self.buffer, block))
+        n = (x.shape[0] // self.block_size) * self.block_size
+        self.buffer = x[n:]
+        if n == 0:
+            y = np.zeros((0, self.nchannels))
+        else:
+            y = self._process_blocks(x[:n])
+        self.n_out += y.shape[0]
+        return self._format(y)
+
+    def flush(self):
+        """Returns the rest of the output (including the len(h)-1 sample tail),
+            and resets the convolver
+        """
+        if self.buffer is None:
+            return np.zeros(0)
+        remaining = self.n_in + self.h_len - 1 - self.n_out
+        b = self.block_size
+        pad = int(np.ceil(remaining / float(b)))*b - self.buffer.shape[0]
+        if pad > 0:
+            x = np.concatenate((self.buffer, np.zeros((pad, self.buffer.shape[1]))))
+            y = self._process_blocks(x)[:remaining]
+        else:
+            y = np.zeros((0, self.nchannels))
+        y = self._format(y)
+        self.reset()
+        return y
+
+    def convolve(self, x, chunk_blocks=8):
+        """Convolves a whole signal with h
+
+            Parameters
+            ----------
+            x : array
+                The input. Can be 1- or 2-d
+            chunk_blocks : int
+                The number of blocks to process at once. [default = 8]
+
+            Returns
+            -------
+            y : array
+                x convolved with h, len(x)+len(h)-1 samples long
+        """
+        self.reset()
+        n = self.block_size * chunk_blocks
+        out = []
+        for i in range(0, max(len(x), 1), n):
+            out.append(self.process(x[i:i+n]))
+        out.append(self.flush())
+        return np.concatenate(out)
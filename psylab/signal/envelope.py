@@ -24,7 +24,8 @@
 #
 
 import numpy as np
-from scipy.signal import filter_design as filters, filtfilt, hilbert
+from scipy.signal import filtfilt, hilbert
+from .filter import butter
 
 def envelope(signal,fs,use_hilbert=False,env_cutoff=16.,env_order=4.):
     '''Extracts the amplitude envelope from a signal
@@ -59,7 +60,7 @@ def envelope(signal,fs,use_hilbert=False,env_cutoff=16.,env_order=4.):
         # finestructure = np.arctan(h/signal)
     else:
         env = np.maximum(signal,0)
-        env_b,env_a = filters.butter(env_order/2.,np.float32(env_cutoff)/(np.float32(fs)/2.))
+        env_b,env_a = butter(env_order/2.,np.float32(env_cutoff)/(np.float32(fs)/2.))
         env = filtfilt(env_b,env_a,env)
 
     return env
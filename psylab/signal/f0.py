@@ -24,7 +24,9 @@
 #
 
 import numpy as np
-from scipy.signal import filter_design as filters, lfilter, filtfilt
+from scipy.signal import lfilter, filtfilt
+from .envelope import envelope
+from .filter import butter
 
 def f0(sig,fs,noisegate=15):
     '''Estimates the fundamental frequency of a signal
@@ -46,9 +48,9 @@ def f0(sig,fs,noisegate=15):
     '''
     
     # Low-pass at 270 Hz (above most F0's)
-    b,a = filters.butter(4,270./(fs/2.))
+    b,a = butter(4,270./(fs/2.))
     fsig = filtfilt(b,a,sig)
-    b,a = filters.butter(4,60./(fs/2.),btype='high')
+    b,a = butter(4,60./(fs/2.),btype='high')
     fsig = filtfilt(b,a,fsig)
     # Get zero crossings
     zc = np.array(np.where(np.sign(fsig[1:]) != np.sign(fsig[:-1]))).transpose()[:,0]
@@ -70,7 +72,7 @@ def f0(sig,fs,noisegate=15):
     # The 2 here corrects for the half-period issue above
     f = (1./ps)/2.
     # Smooth the F0 track
-    b,a = filters.butter(1,16./(fs/2.))
+    b,a = butter(1,16./(fs/2.))
     f = filtfilt(b,a,f)
     
     # Voicing
@@ -91,7 +93,7 @@ def f0(sig,fs,noisegate=15):
 #        else:
 #            skip = True
     # Smooth the transitions
-    b,a = filters.butter(1,16./(fs/2.))
+    b,a = butter(1,16./(fs/2.))
     envf = filtfilt(b,a,env)
 
     return f * np.maximum(envf,0)
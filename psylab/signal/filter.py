@@ -23,9 +23,114 @@
 # cbrown1@pitt.edu.
 #
 
+import collections
 import numpy as np
 import scipy.signal
 
+# A shared, bounded (least-recently-used) cache of designed filters, so that 
+# functions that are called repeatedly with the same parameters (eg., in a 
+# trial loop) don't redesign the same filters every time. See butter.
+filter_cache_maxsize = 512
+_filter_cache = collections.OrderedDict()
+_filter_cache_stats = {'hits': 0, 'misses': 0}
+
+_btypes = {
+    'low': 'lowpass', 'lowpass': 'lowpass', 'lp': 'lowpass',
+    'high': 'highpass', 'highpass': 'highpass', 'hp': 'highpass',
+    'band': 'bandpass', 'bandpass': 'bandpass', 'bp': 'bandpass', 'pass': 'bandpass',
+    'bandstop': 'bandstop', 'stop': 'bandstop', 'bs': 'bandstop',
+    }
+
+def butter(order, wn, btype='low', analog=False, output='ba', fs=None):
+    """Designs a Butterworth filter, reusing previously designed filters
+
+        A drop-in replacement for scipy.signal.butter. Designed filters are 
+        kept in a cache shared by all psylab.signal functions, keyed by 
+        (order, cutoffs, btype, analog, output, fs), so that repeated calls 
+        with the same parameters skip filter design entirely. The cache is 
+        bounded: when it holds filter_cache_maxsize filters, the least 
+        recently used one is discarded.
+
+        The returned coefficient arrays are copies, so they can be modified 
+        (and passed to functions, like sosfilt, that require writable 
+        arrays) without affecting the cache.
+
+        Parameters
+        ----------
+        order : int
+            The filter order
+        wn : scalar or array
+            The cutoff frequency(ies), normalized to the nyquist frequency 
+            (ie., 0 < wn < 1), unless fs is specified or analog is True
+        btype : str
+            The type of filter ['low','high','band','bandstop']
+        analog : bool
+            If True, design an analog filter, with wn in rad/s
+        output : str
+            The type of output ['ba','zpk','sos']
+        fs : scalar
+            The sampling frequency, in which case wn is in the same units. 
+            Requires scipy >= 1.2
+
+        Returns
+        -------
+        coefs : tuple or array
+            (b, a) for 'ba', (z, p, k) for 'zpk', or an array of second-order
+            sections for 'sos'
+
+        See Also
+        --------
+        filter_cache_info, filter_cache_clear
+    """
+    wn_key = tuple(float(w) for w in np.atleast_1d(wn))
+    key = (float(order), wn_key, _btypes.get(btype, btype), bool(analog), 
+           output, fs if fs is None else float(fs))
+    try:
+        coefs = _filter_cache.pop(key)
+        _filter_cache_stats['hits'] += 1
+    except KeyError:
+        _filter_cache_stats['misses'] += 1
+        if fs is None:
+            # Don't pass fs at all, so older scipys still work
+            coefs = scipy.signal.butter(order, wn, btype=btype, analog=analog, 
+                                        output=output)
+        else:
+            coefs = scipy.signal.butter(order, wn, btype=btype, analog=analog, 
+                                        output=output, fs=fs)
+        while len(_filter_cache) >= max(filter_cache_maxsize, 1):
+            _filter_cache.popitem(last=False)
+    # (Re)insert as most recently used
+    _filter_cache[key] = coefs
+    if isinstance(coefs, tuple):
+        return tuple([np.copy(c) for c in coefs])
+    else:
+        return coefs.copy()
+
+
+def filter_cache_info():
+    """Returns statistics on the filter design cache used by butter
+
+        Returns
+        -------
+        info : dict
+            'hits' and 'misses' are the number of calls to butter that did and 
+            did not find a designed filter in the cache, 'size' is the number 
+            of filters currently cached, and 'maxsize' is the bound on size.
+    """
+    return {'hits': _filter_cache_stats['hits'],
+            'misses': _filter_cache_stats['misses'],
+            'size': len(_filter_cache),
+            'maxsize': filter_cache_maxsize,
+           }
+
+
+def filter_cache_clear():
+    """Empties the filter design cache used by butter, and resets its statistics
+    """
+    _filter_cache.clear()
+    _filter_cache_stats['hits'] = 0
+    _filter_cache_stats['misses'] = 0
+
 def pre_emphasis(signal, fs, hp=50):
     """Applies a pre-emphasis filter to a signal
         
@@ -49,7 +154,7 @@ def pre_emphasis(signal, fs, hp=50):
     return sig[1:] - alpha * sig[:-1]
     
 
-def filter_bank(signal, fs, order, cfs, btype='band'):
+def filter_bank(signal, fs, order, cfs, btype='band', sos=False, zero_phase=False):
     """Filters the input array with a bank of filters
         
         Filters a signal with the cutoff frequencies specified in cfs. 
@@ -62,6 +167,18 @@ def filter_bank(signal, fs, order, cfs, btype='band'):
         (ie., it can already have been filter_banked; eg., bandpass 
         filtering followed by envelope extraction, which is the usecase 
         that this function was written for). 
+
+        If sos is True, the filters are designed and applied as second-order 
+        sections, which remain stable at high orders and low cutoffs where 
+        the default (b, a) form does not. In this mode, the highpass and 
+        lowpass filters of each band are cascaded into a single filter, and 
+        all channels that share the same filter (eg., low-pass envelope 
+        filters with the same cutoff) are filtered together in one call. 
+        The input signal is never modified. In the default mode, a 2-d input 
+        signal is filtered in place.
+
+        If zero_phase is True, the filters are applied forwards and backwards
+        (ie., with filtfilt or sosfiltfilt), which doubles the effective order.
         
         Parameters
         ----------
@@ -75,12 +192,23 @@ def filter_bank(signal, fs, order, cfs, btype='band'):
             An array of cutoff frequencies
         btype : str
             The type of filter to implement ['band','low','high']
+        sos : bool
+            True to use second-order sections [default = False]
+        zero_phase : bool
+            True to apply zero-phase filtering [default = False]
             
         Returns
         -------
         y : 2-d array
             The filtered signal, with the output of each filter along dim 1
     """
+    if sos:
+        return _filter_bank_sos(signal, fs, order, cfs, btype, zero_phase)
+
+    if zero_phase:
+        filt = scipy.signal.filtfilt
+    else:
+        filt = scipy.signal.lfilter
 
     if len(signal.shape) == 1:
         out = np.tile(signal,(cfs.size-1,1)).T
@@ -92,16 +220,125 @@ def filter_bank(signal, fs, order, cfs, btype='band'):
     nyq = fs/2.
     for i in range(len(cfs)-1):
         if btype in ['high', 'band']:
-            b_hp,a_hp=scipy.signal.filter_design.butter(order[i],(cfs[i]/nyq),btype='high')
-            out[:,i] = scipy.signal.lfilter(b_hp,a_hp,out[:,i])
+            b_hp,a_hp=butter(order[i],(cfs[i]/nyq),btype='high')
+            out[:,i] = filt(b_hp,a_hp,out[:,i])
         if btype in ['low','band']:
-            b_lp,a_lp=scipy.signal.filter_design.butter(order[i],(cfs[i+1]/nyq))
-            out[:,i] = scipy.signal.lfilter(b_lp,a_lp,out[:,i])
+            b_lp,a_lp=butter(order[i],(cfs[i+1]/nyq))
+            out[:,i] = filt(b_lp,a_lp,out[:,i])
+    if len(cfs) == 2:
+        out = out.flatten()
+    return out
+
+
+def _filter_bank_sos(signal, fs, order, cfs, btype, zero_phase):
+    """The second-order sections implementation of filter_bank
+    """
+    groups = design_sos_bank(fs, order, cfs, btype)
+    out = apply_sos_bank(groups, signal, cfs.size-1, per_channel=len(signal.shape) > 1, zero_phase=zero_phase)
     if len(cfs) == 2:
         out = out.flatten()
     return out
 
 
+def design_sos_bank(fs, order, cfs, btype='band'):
+    """Designs a bank of filters as second-order sections
+
+        The bank is designed as in filter_bank: cfs[:-1] are used as highpass
+        cutoff frequencies, and cfs[1:] as lowpass cutoff frequencies. The 
+        highpass and lowpass filters of each band are cascaded into a single 
+        filter, and channels that have identical filters are grouped 
+        together, so that they can be filtered in a single call.
+
+        Parameters
+        ----------
+        fs : scalar
+            The sampling frequency
+        order : scalar or array
+            The filter order to use (or one order per cutoff frequency)
+        cfs : array
+            An array of cutoff frequencies
+        btype : str
+            The type of filter to implement ['band','low','high']
+
+        Returns
+        -------
+        groups : list
+            A list of (sos, channels) tuples, where channels is a list of the 
+            channel indices that use the filter sos. Pass to apply_sos_bank
+    """
+    nch = cfs.size-1
+    if isinstance(order, (int,float)) == 1:
+        order = np.tile(order,(cfs.size,)).T
+
+    nyq = fs/2.
+    groups = collections.OrderedDict()
+    for i in range(nch):
+        sections = []
+        if btype in ['high', 'band']:
+            sections.append(butter(order[i],(cfs[i]/nyq),btype='high',output='sos'))
+        if btype in ['low','band']:
+            sections.append(butter(order[i],(cfs[i+1]/nyq),output='sos'))
+        sos = np.vstack(sections)
+        key = sos.tobytes()
+        if key in groups:
+            groups[key][1].append(i)
+        else:
+            groups[key] = (sos, [i])
+    return list(groups.values())
+
+
+def apply_sos_bank(groups, signal, nch, per_channel=False, zero_phase=False):
+    """Applies a bank of filters designed with design_sos_bank
+
+        Parameters
+        ----------
+        groups : list
+            The filter bank, as returned by design_sos_bank
+        signal : array
+            The input signal, filtered along axis 0. If per_channel is False, 
+            every filter is applied to the whole signal, and any further axes 
+            (eg., a batch of signals along axis 1) are preserved. If 
+            per_channel is True, axis 1 must be of length nch, and each 
+            channel is filtered with its own filter.
+        nch : int
+            The number of channels in the bank
+        per_channel : bool
+            See signal [default = False]
+        zero_phase : bool
+            True to apply zero-phase filtering [default = False]
+
+        Returns
+        -------
+        y : array
+            The filtered signal, with the output of each filter along axis 1
+    """
+    if zero_phase:
+        filt = scipy.signal.sosfiltfilt
+    else:
+        filt = scipy.signal.sosfilt
+
+    signal = np.asarray(signal)
+    dtype = np.result_type(signal, np.float64)
+    # Work channel-major, with time along the last axis, so that each filter 
+    # runs over contiguous memory, and each group of channels is a single 
+    # block of rows
+    x = np.ascontiguousarray(np.moveaxis(signal, 0, -1), dtype=dtype)
+    if per_channel:
+        out = np.empty(x.shape, dtype=dtype)
+    else:
+        out = np.empty((nch,) + x.shape, dtype=dtype)
+    for sos, chans in groups:
+        if chans == list(range(chans[0], chans[-1]+1)):
+            chans = slice(chans[0], chans[-1]+1)
+        if per_channel:
+            out[chans] = filt(sos, x[chans], axis=-1)
+        else:
+            # Same filter, same input: filter once and copy
+            out[chans] = filt(sos, x, axis=-1)
+    # Back to time along axis 0 (a view; the result is column-major)
+    return np.moveaxis(out, -1, 0)
+
+
 def freqs_logspace(start, stop, n):
     """Compute frequencies equally spaced in log space
     
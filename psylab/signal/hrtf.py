@@ -55,6 +55,9 @@ def convolve(x, h):
         1-d arrays, and the speed difference decreases as the number of 
         channels increases (performance was about .75 that of np.convolve when 
         x had 32-channels).
+
+        For long signals or impulse responses, or for streaming, Convolver 
+        is faster and uses less memory.
     '''
     def nextpow2(x):  
         return 2**(x-1).bit_length()
@@ -96,13 +99,20 @@ class hrtf_data():
         circle, in integer degrees starting with 0 (ie., if there are four 
         azimuths, they are assumed to be 0, 90, 180, and 270). Thus, all data 
         in a datafile should be for a single elevation. 
+
+        If mmap is True, the datafile is memory-mapped rather than loaded, so 
+        that only the azimuths that are used are read from disk.
     """
-    def __init__(self, file_path):
-        self.data = np.load(file_path)
-        self.degrees_separation = 360./self.data.shape[1]
+    def __init__(self, file_path, mmap=False):
+        if mmap:
+            self.data = np.load(file_path, mmap_mode='r')
+        else:
+            self.data = np.load(file_path)
         if len(self.data.shape) == 1:
+            self.degrees_separation = 360.
             self.locations = np.array((0))
         else:
+            self.degrees_separation = 360./self.data.shape[1]
             self.locations = np.round(np.linspace(0,360,self.data.shape[1]+1)[:-1])
 #            self.locations = np.round(np.arange(0, 360, self.degrees_separation))
 
@@ -111,30 +121,199 @@ class hrtf_data():
 #        return self.data.keys()
 
     def get_left_right_inds(self, az):
-        l = np.round((int(az) % 360) / self.degrees_separation)
-        r = np.round(((360-(int(az) % 360)) % 360) / self.degrees_separation)
+        l = self.get_ind(az)
+        r = self.get_ind(360-(int(az) % 360))
         return (l,r)
 
     def get_left_right_data(self, az):
         (l,r) = self.get_left_right_inds(int(az))
-        l_data = self.data[l]
-        r_data = self.data[r]
-        return (l_data, r_data)
+        return (self._column(l), self._column(r))
         
     def apply_left_right_data(self, signal, az):
+        """Returns a 2-column array: the left channel of signal convolved with 
+            the left-ear hrtf, and the right channel with the right-ear hrtf
+        """
         (l,r) = self.get_left_right_data(int(az))
-        sig_out = np.zeros_like(signal)
-        sig_out[:,0] = np.convolve(signal[:,0],l)
-        sig_out[:,1] = np.convolve(signal[:,1],r)
+        if signal.ndim == 1:
+            signal = np.column_stack((signal, signal))
+        return np.column_stack((np.convolve(signal[:,0],l), np.convolve(signal[:,1],r)))
 
     def get_ind(self, az):
-        return np.round((int(az) % 360)/ self.degrees_separation)
+        return int(np.round((int(az) % 360)/ self.degrees_separation)) % self._n_locations()
         
     def get_data(self, az):
         i = self.get_ind(int(az))
-        return self.data[i]
+        return self._column(i)
     
     def apply_data(self, signal, az):
         data = self.get_data(int(az))
-        sig_out = np.zeros_like(signal)
-        sig_out = np.convolve(signal,data)
+        return np.convolve(signal,data)
+
+    def get_interp_data(self, az):
+        """Returns the hrtf for a (possibly fractional) azimuth, linearly 
+            interpolated between the two nearest measured azimuths
+        """
+        n = self._n_locations()
+        pos = (az % 360) / self.degrees_separation
+        i0 = int(np.floor(pos)) % n
+        i1 = (i0 + 1) % n
+        frac = pos - np.floor(pos)
+        if frac == 0:
+            return np.array(self._column(i0), dtype=float)
+        return (1-frac)*self._column(i0) + frac*self._column(i1)
+
+    def _n_locations(self):
+        if len(self.data.shape) == 1:
+            return 1
+        return self.data.shape[1]
+
+    def _column(self, i):
+        if len(self.data.shape) == 1:
+            return self.data
+        return self.data[:,i]
+
+
+class HrtfRenderer():
+    """Spatializes signals with hrtfs, including moving sources
+
+        The frequency response of each azimuth is computed once, at the FFT 
+        size needed, and cached. Azimuths between those measured are 
+        interpolated (linearly, in the time domain). Time-varying azimuth 
+        trajectories are rendered with block convolution, crossfading from 
+        the previous block's hrtfs to the current block's across each block.
+
+        Parameters
+        ----------
+        hrtf : hrtf_data or str
+            The hrtf data to use. If a path to a .npy file is given, it is 
+            memory-mapped (see hrtf_data). As with hrtf_data.get_left_right_data, 
+            the left ear uses the azimuth, and the right ear the mirror image.
+        block_size : int
+            The block size, in samples, of trajectory rendering. The azimuth 
+            is updated, and a crossfade applied, once per block. [default = 512]
+        resolution : float
+            Azimuths are rounded to this many degrees, so that nearby azimuths 
+            share cached spectra. [default = 1]
+        cache_size : int
+            The maximum number of spectra to cache. [default = 1024]
+
+        Example
+        -------
+        r = HrtfRenderer('kemar_0el.npy')
+        out = r.render(sig, 45)                                    # Static
+        out = r.render(sig, np.linspace(0, 360, len(sig)))         # Moving
+    """
+    def __init__(self, hrtf, block_size=512, resolution=1., cache_size=1024):
+        if isinstance(hrtf, hrtf_data):
+            self.hrtf = hrtf
+        else:
+            self.hrtf = hrtf_data(hrtf, mmap=True)
+        self.block_size = int(block_size)
+        self.resolution = float(resolution)
+        self.cache_size = cache_size
+        self.n_taps = self.hrtf.data.shape[0]
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _quantize(self, az):
+        return float(np.round((az % 360) / self.resolution) * self.resolution % 360)
+
+    def get_hrir(self, az):
+        """Returns the left and right hrtfs (impulse responses) for an azimuth, 
+            as a 2-column array
+        """
+        az = self._quantize(az)
+        return np.column_stack((self.hrtf.get_interp_data(az), 
+                                self.hrtf.get_interp_data((360 - az) % 360)))
+
+    def get_spectra(self, az, nfft):
+        """Returns the left and right frequency responses for an azimuth, at a 
+            given FFT size, as an (nfft/2+1) x 2 array
+        """
+        key = (self._quantize(az), int(nfft))
+        H = self._cache.get(key)
+        if H is not None:
+            self.hits += 1
+            self._cache.pop(key)
+            self._cache[key] = H
+        else:
+            self.misses += 1
+            H = np.fft.rfft(self.get_hrir(key[0]), int(nfft), axis=0)
+            self._cache[key] = H
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return H
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 
+                'size': len(self._cache), 'maxsize': self.cache_size}
+
+    def render(self, signal, az):
+        """Spatializes a mono signal
+
+            Parameters
+            ----------
+            signal : array
+                The signal to render (1-d)
+            az : scalar or array
+                The azimuth, in degrees. Either a scalar, for a stationary 
+                source, or an array with one azimuth per sample of signal, 
+                for a moving source.
+
+            Returns
+            -------
+            y : array
+                A 2-column (left, right) array, len(signal)+n_taps-1 samples 
+                long
+        """
+        signal = np.asarray(signal, dtype=float)
+        ly = signal.shape[0] + self.n_taps - 1
+        if np.ndim(az) == 0:
+            # Nothing to crossfade, so use longer blocks
+            b = max(self.block_size, 4096)
+        else:
+            b = self.block_size
+        nb = int(np.ceil(ly / float(b)))
+        nfft = 2**(b + self.n_taps - 2).bit_length()
+
+        # One azimuth per block (the tail keeps the last one)
+        if np.ndim(az) == 0:
+            block_az = [az]
+            inds = np.zeros(nb, dtype=int)
+        else:
+            az = np.asarray(az, dtype=float)
+            if az.shape[0] != signal.shape[0]:
+                raise ValueError("az must be a scalar, or have one value per sample of signal")
+            block_az = az[np.minimum(np.arange(nb)*b, az.shape[0]-1)]
+            block_az, inds = np.unique([self._quantize(a) for a in block_az], return_inverse=True)
+        H = np.array([self.get_spectra(a, nfft) for a in block_az])
+
+        return self._render_blocks(signal, H, inds, b, nfft)[:ly]
+
+    def _render_blocks(self, signal, H, inds, b, nfft, chunk_blocks=256):
+        """Convolves each b-sample block of signal with the spectra H[inds], 
+            crossfading from the previous block's spectra where they differ
+        """
+        nb = inds.shape[0]
+        # Each block is the last b samples of the circular convolution of 
+        # the nfft samples ending with it
+        x = np.concatenate((np.zeros(nfft-b), signal, np.zeros(nb*b-signal.shape[0])))
+        prev_inds = np.concatenate((inds[:1], inds[:-1]))
+
+        fade = (np.arange(b) / float(b))[:,np.newaxis]
+        y = np.zeros((nb*b, 2))
+        for start in range(0, nb, chunk_blocks):
+            stop = min(start + chunk_blocks, nb)
+            frames = np.array([x[j*b:j*b+nfft] for j in range(start, stop)])
+            X = np.fft.rfft(frames, axis=1)[:,:,np.newaxis]
+            new = np.fft.irfft(X * H[inds[start:stop]], nfft, axis=1)[:,-b:]
+            moving = inds[start:stop] != prev_inds[start:stop]
+            if np.any(moving):
+                old = np.fft.irfft(X[moving] * H[prev_inds[start:stop][moving]], nfft, axis=1)[:,-b:]
+                new[moving] = old*(1-fade) + new[moving]*fade
+            y[start*b:stop*b] = new.reshape(-1, 2)
+        return y
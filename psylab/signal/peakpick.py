@@ -79,7 +79,8 @@ def pick_peaks(sig, n, window_size):
     m = sig.shape[1]
     # Compute rms in each window in each channel
     # (overlap is not used here, but it's available in the function)
-    rms = np.sqrt(np.mean(sliding_window(sig,(window_size,m))**2,axis=1))
+    frames = sliding_window(sig,(window_size,m),flatten=False)[:,0]
+    rms = np.sqrt(np.mean(frames**2,axis=1))
     # Sort & take last n indexes, along dim 1
     peak_channels = np.argsort(rms,1)[:,-n:]
     peak_channels.sort(axis=1)
@@ -25,6 +25,8 @@
 #
 
 import numpy as np
+from collections import OrderedDict
+from .convolution import Convolver
 
 # Start meshgrid
 def meshgrid(*xi,**kwargs):
@@ -169,33 +171,23 @@ def fconv(x, h):
         Returns
         -------
         y : array
-            x convolved with h
-    '''
-    def nextpow2(i):
-        n = 2 
-        while n < i: 
-            n *= 2
-        return n 
-
-    ly = len(x) + len(h) - 1
-    ly2 = 2**(nextpow2(ly))
-
-    m = max(abs(x))
-    x = np.fft(x, ly2)
-    h = np.fft(h, ly2)
-
-    y = x * h
+            x convolved with h, scaled so that its peak matches that of x
 
-    y = np.real(np.ifft(y, ly2)) # Inverse fast Fourier transform
-    y = y[:ly]
-    m = m/max(abs(y))
+        Notes
+        -----
+        Uses a partitioned convolver (see Convolver), so long inputs and 
+        long impulse responses are handled efficiently.
+    '''
+    m = np.max(np.abs(x))
+    y = Convolver(h).convolve(x)
+    m = m/np.max(np.abs(y))
     y = m*y
 
     return y
     
 
 
-def rir(fs, rm, src, mic, n, r):
+def rir(fs, rm, src, mic, n, r, fractional_delay=False, chunk_size=None, max_time=None, min_level=None):
     '''Generates room impulse responses
 
         Parameters
@@ -212,6 +204,25 @@ def rir(fs, rm, src, mic, n, r):
             program accounts  for (2*n+1)^3 virtual sources
         r: scalar
             reflection coefficient of surfaces. (-1 < r < 1)
+        fractional_delay: bool
+            If False, each virtual source is placed at the nearest sample. 
+            Arrivals that fall on the same sample are summed. If True, each 
+            virtual source is placed at its exact (fractional) delay using a 
+            Hann-windowed sinc interpolator, 32 samples long. [default = False]
+        chunk_size: scalar
+            The approximate number of virtual sources to evaluate at once. 
+            The lattice is processed in slabs of (2*n+1)^2 sources, so peak 
+            memory use is bounded by chunk_size rather than by (2*n+1)^3. 
+            The result is the same as the dense computation. If None, all 
+            sources are evaluated at once. [default = None]
+        max_time: scalar
+            If specified, virtual sources arriving later than max_time (in 
+            seconds) are discarded, and the response is truncated to that 
+            length. [default = None]
+        min_level: scalar
+            If specified, virtual sources whose amplitude is more than 
+            min_level dB below that of the direct sound are discarded. 
+            [default = None]
         
         Returns
         -------
@@ -223,37 +234,204 @@ def rir(fs, rm, src, mic, n, r):
         You can use fconv for fast convolution of the generated ir with a waveform
         Derived from Matlab code written by Stephen McGovern. 
         Copyright (c) 2003, Stephen McGovern; All rights reserved. 
+
+        Approximate run times (fs = 44100, r = .968, the room in the example):
+
+              n   sources  fractional_delay=False  fractional_delay=True
+             12     15625                 0.005 s                 0.05 s
+             25    132651                  0.01 s                 0.36 s
+             50   1030301                  0.08 s                 2.70 s
         
         Examples
         --------
         fs = 44100; n = 12; r = .968; 
         rm = [4.59, 6.64, 2.6];  src = [1.43, 6.25, 1.3];  mic = [2.8, 2.5, 1.3];
         ir = rir(fs, rm, src, mic, n, r);
+
+        # n = 100 is 8 million sources; evaluate them 1 million at a time 
+        # and ignore those more than 80 dB down
+        ir = rir(fs, rm, src, mic, 100, r, chunk_size=1e6, min_level=80);
         
     '''
-    
-    nn = np.array(range(-n, n+1))
-    rms = nn + 0.5 - 0.5*(-1.)**nn
-    srcs = (-1.)**nn
 
-    xi = srcs*src[0] + rms*rm[0]-mic[0]
-    yj = srcs*src[1] + rms*rm[1]-mic[1]
-    zk = srcs*src[2] + rms*rm[2]-mic[2]
-    
-    i,j,k = meshgrid(xi,yj,zk,indexing="ij")
+    h = _rir(fs, rm, np.array([src], dtype=float), np.array([mic], dtype=float), n, r, 
+             fractional_delay, chunk_size, max_time, min_level)[0]
 
-    d = np.sqrt(i**2 + j**2 + k**2)
-    time = np.round(fs*d/343) + 1
+    return h/np.max(np.abs(h))
 
-    e,f,g = meshgrid(nn, nn, nn, indexing="ij")
-    c = r**(np.abs(e) + np.abs(f) + np.abs(g))
-    e = c/d
 
-    # Equivalent to Matlab: h = full(sparse(time(:),1,e(:)))
-    h = np.zeros(int(time.flatten().max()))
-    timeflat = time.flatten()  # Memoize
-    eflat = e.flatten()  # Memoize
-    for i in xrange(len(timeflat)):
-        h[int(timeflat[i])-1] = eflat[i]
+def rir_multi(fs, rm, src, mic, n, r, fractional_delay=False, chunk_size=None, max_time=None, min_level=None):
+    '''Generates room impulse responses for several receivers and/or sources
 
-    return h/np.max(np.abs(h))
+        The virtual source lattice and reflection coefficients are computed 
+        once per source position and shared by all receivers, and distances 
+        are computed for all receivers at once.
+
+        Parameters
+        ----------
+        fs: scalar
+            Sampling frequency 
+        rm: list
+            [x y z] dimensions of room ( in meters )
+        src: array
+            [x y z] coords of the sound source, or an m x 3 array of source 
+            coords, one for each receiver
+        mic: array
+            An m x 3 array of receiver ( microphone ) coords
+        n: scalar
+            program accounts  for (2*n+1)^3 virtual sources
+        r: scalar
+            reflection coefficient of surfaces. (-1 < r < 1)
+        fractional_delay, chunk_size, max_time, min_level: 
+            See rir. chunk_size is the number of virtual sources evaluated 
+            at once, summed across receivers. min_level is relative to the 
+            direct sound at each receiver.
+        
+        Returns
+        -------
+        y : array
+            An array of impulse responses, one per column. All responses are 
+            the same length, and are normalized by the same value so that 
+            level differences across receivers are preserved. 
+            
+        Examples
+        --------
+        # A binaural pair, the ears 18 cm apart
+        fs = 44100; n = 12; r = .968; 
+        rm = [4.59, 6.64, 2.6];  src = [1.43, 6.25, 1.3];
+        mics = [[2.71, 2.5, 1.3], [2.89, 2.5, 1.3]];
+        ir = rir_multi(fs, rm, src, mics, n, r);
+        
+    '''
+    mic = np.atleast_2d(np.array(mic, dtype=float))
+    src = np.atleast_2d(np.array(src, dtype=float))
+    if src.shape[0] == 1:
+        src = np.tile(src, (mic.shape[0], 1))
+    elif src.shape[0] != mic.shape[0]:
+        raise ValueError("src must be a single position or one position per receiver")
+
+    h = _rir(fs, rm, src, mic, n, r, fractional_delay, chunk_size, max_time, min_level)
+
+    return h.T/np.max(np.abs(h))
+
+
+def _rir(fs, rm, srcs, mics, n, r, fractional_delay, chunk_size, max_time, min_level):
+    """Returns unnormalized impulse responses, one row for each source/receiver 
+        pair (the rows of srcs and mics)
+    """
+    nch = mics.shape[0]
+
+    # Receivers that share a source share a lattice
+    groups = OrderedDict()
+    for i,s in enumerate(map(tuple, srcs)):
+        groups.setdefault(s, []).append(i)
+    lattices = dict((s, _image_lattice(rm, s, n)) for s in groups)
+
+    # The farthest virtual source sets the length of the responses
+    length = 0
+    for s,chans in groups.items():
+        xi, yj, zk, nn = lattices[s]
+        m = mics[chans]
+        dmax = np.sqrt(np.max((xi[:,np.newaxis]-m[:,0])**2, axis=0) + 
+                       np.max((yj[:,np.newaxis]-m[:,1])**2, axis=0) + 
+                       np.max((zk[:,np.newaxis]-m[:,2])**2, axis=0))
+        length = max(length, _response_length(fs*np.max(dmax)/343., fractional_delay))
+    if max_time is not None:
+        length = min(length, int(max_time*fs)+1)
+
+    if min_level is None:
+        floor = None
+    else:
+        floor = 10**(-min_level/20.) / np.sqrt(np.sum((srcs-mics)**2, axis=1))
+
+    h = np.zeros((nch, length))
+    for s,chans in groups.items():
+        m = mics[chans].T.reshape(3, -1, 1, 1, 1)
+        if chunk_size is None:
+            planes = 2*n+1
+        else:
+            planes = max(1, int(chunk_size) // ((2*n+1)**2 * len(chans)))
+        for x,y,z,c in _image_slabs(lattices[s], n, r, planes):
+            d = np.sqrt((x-m[0])**2 + (y-m[1])**2 + (z-m[2])**2)
+            e = c/d
+            delays = fs*d/343.
+            rows = np.broadcast_to(np.arange(len(chans)).reshape(-1, 1, 1, 1), d.shape)
+            if floor is not None:
+                keep = np.abs(e) >= floor[chans].reshape(-1, 1, 1, 1)
+                delays = delays[keep]
+                e = e[keep]
+                rows = rows[keep]
+            h[chans] += _accumulate_arrivals(delays, e, fractional_delay, length, rows, len(chans))
+
+    return h
+
+
+_fd_half_length = 16
+
+def _image_lattice(rm, src, n):
+    """Returns the x, y, and z coordinates of the virtual sources along each 
+        axis of the lattice, and the reflection orders
+    """
+    nn = np.arange(-n, n+1)
+    rms = nn + 0.5 - 0.5*(-1.)**nn
+    srcs = (-1.)**nn
+    return (srcs*src[0] + rms*rm[0], 
+            srcs*src[1] + rms*rm[1], 
+            srcs*src[2] + rms*rm[2], 
+            np.abs(nn))
+
+def _image_slabs(lattice, n, r, planes):
+    """Yields the coordinates and reflection coefficients of the virtual 
+        sources, planes x (2*n+1)^2 at a time. Coordinates are broadcastable 
+        against the coefficients
+    """
+    xi, yj, zk, nn = lattice
+    yz = nn[:,np.newaxis] + nn[np.newaxis,:]
+    for start in range(0, 2*n+1, planes):
+        sl = slice(start, start+planes)
+        c = r**(nn[sl,np.newaxis,np.newaxis] + yz[np.newaxis])
+        yield (xi[sl,np.newaxis,np.newaxis], yj[np.newaxis,:,np.newaxis], 
+               zk[np.newaxis,np.newaxis,:], c)
+
+def _response_length(maxdelay, fractional_delay=False):
+    """Returns the number of samples needed to hold an arrival at maxdelay
+    """
+    if fractional_delay:
+        return int(np.floor(maxdelay)) + _fd_half_length + 1
+    else:
+        return int(np.round(maxdelay)) + 1
+
+def _accumulate_arrivals(delays, amps, fractional_delay=False, length=None, rows=None, nrows=1):
+    """Sums the arrivals of each virtual source into an impulse response
+
+        Equivalent to Matlab: h = full(sparse(time(:),1,e(:))), ie., arrivals
+        that fall on the same sample are summed. delays are in (fractional) 
+        samples. If length is specified, the response is that many samples 
+        long, and later arrivals are discarded. If rows is specified, it 
+        holds the row (0 to nrows-1) that each arrival belongs to, and an 
+        nrows x length array of responses is returned.
+    """
+    delays = np.ravel(delays)
+    amps = np.ravel(amps)
+    if not fractional_delay:
+        inds = np.round(delays).astype(int)
+        vals = amps
+    else:
+        offsets = np.arange(-_fd_half_length+1, _fd_half_length+1)
+        inds = np.floor(delays).astype(int)[:,np.newaxis] + offsets
+        x = inds - delays[:,np.newaxis]
+        vals = amps[:,np.newaxis] * np.sinc(x) * (.5 + .5*np.cos(np.pi*x/_fd_half_length))
+    if rows is None:
+        if length is None:
+            valid = inds >= 0
+            return np.bincount(inds[valid], weights=vals[valid])
+        else:
+            valid = (inds >= 0) & (inds < length)
+            return np.bincount(inds[valid], weights=vals[valid], minlength=length)
+    else:
+        rows = np.ravel(rows)
+        if fractional_delay:
+            rows = rows[:,np.newaxis]
+        valid = (inds >= 0) & (inds < length)
+        inds = (inds + rows*length)[valid]
+        return np.bincount(inds, weights=vals[valid], minlength=nrows*length).reshape(nrows, length)
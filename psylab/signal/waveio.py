@@ -37,139 +37,292 @@ import warnings
 class WavFileWarning(UserWarning):
     pass
 
-_big_endian = False
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# The last 14 bytes of the KSDATAFORMAT_SUBTYPE GUIDs; the first 2 are the 
+# format tag
+_subformat_guid_tail = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
 
 # assumes file pointer is immediately
 #  after the 'fmt ' id
-def _read_fmt_chunk(fid):
-    if _big_endian:
+def _read_fmt_chunk(fid, big_endian=False):
+    """Returns size, comp, noc, rate, sbytes, ba, bits. For extensible files, 
+        comp is the format tag of the subformat (ie., PCM or IEEE float)
+    """
+    if big_endian:
         fmt = '>'
     else:
         fmt = '<'
-    res = struct.unpack(fmt+'ihHIIHH',fid.read(20))
-    size, comp, noc, rate, sbytes, ba, bits = res
-    if (comp != 1 or size > 16):
+    size = struct.unpack(fmt+'I',fid.read(4))[0]
+    res = struct.unpack(fmt+'HHIIHH',fid.read(16))
+    comp, noc, rate, sbytes, ba, bits = res
+    extra = fid.read(size-16)
+    if comp == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+        # cbSize, wValidBitsPerSample, dwChannelMask, SubFormat
+        comp = struct.unpack(fmt+'H', extra[8:10])[0]
+    if comp not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
         warnings.warn("Unfamiliar format bytes", WavFileWarning)
-        if (size>16):
-            fid.read(size-16)
+    if size % 2:
+        fid.read(1)
     return size, comp, noc, rate, sbytes, ba, bits
 
+def _data_dtype(comp, bits, big_endian=False):
+    """Returns the numpy dtype of samples in the file. 24-bit samples have 
+        no numpy dtype, and are returned as 32-bit
+    """
+    if big_endian:
+        order = '>'
+    else:
+        order = '<'
+    if comp == WAVE_FORMAT_IEEE_FLOAT:
+        if bits not in (32, 64):
+            raise ValueError("Unsupported bit depth for float data: {}".format(bits))
+        return np.dtype('%sf%d' % (order, bits//8))
+    if bits == 8:
+        return np.dtype(np.ubyte)
+    if bits == 24:
+        return np.dtype('%si4' % order)
+    if bits not in (16, 32):
+        raise ValueError("Unsupported bit depth: {}".format(bits))
+    return np.dtype('%si%d' % (order, bits//8))
+
 # assumes file pointer is immediately
 #   after the 'data' id
-def _read_data_chunk(fid, noc, bits):
-    if _big_endian:
-        fmt = '>i'
+def _read_data_chunk(fid, noc, bits, big_endian=False, start=None, stop=None, mmap=False, comp=WAVE_FORMAT_PCM):
+    if big_endian:
+        fmt = '>I'
     else:
-        fmt = '<i'
+        fmt = '<I'
     size = struct.unpack(fmt,fid.read(4))[0]
-    if bits == 8:
-        data = np.fromfile(fid, dtype=np.ubyte, count=size)
-        if noc > 1:
-            data = data.reshape(-1,noc)
+    offset = fid.tell()
+    dtype = _data_dtype(comp, bits, big_endian)
+    sample_bytes = bits // 8
+    frame_bytes = sample_bytes * noc
+    start, stop, step = slice(start, stop).indices(size // frame_bytes)
+    count = max(stop - start, 0)
+    if noc > 1:
+        shape = (count, noc)
     else:
-        bytes = bits//8
-        if _big_endian:
-            dtype = '>i%d' % bytes
+        shape = (count,)
+    if bits == 24:
+        if mmap:
+            raise ValueError("24-bit data cannot be memory-mapped")
+        # Unpack into the high 3 bytes of a 4-byte int, so that values are 
+        # left-justified int32 (full scale is the same as for 32-bit)
+        fid.seek(offset + start*frame_bytes)
+        raw = np.fromfile(fid, dtype=np.ubyte, count=count*frame_bytes).reshape(-1, 3)
+        data = np.zeros((raw.shape[0], 4), dtype=np.ubyte)
+        if big_endian:
+            data[:,:3] = raw
         else:
-            dtype = '<i%d' % bytes
-        data = np.fromfile(fid, dtype=dtype, count=size//bytes)
-        if noc > 1:
-            data = data.reshape(-1,noc)
+            data[:,1:] = raw
+        data = data.view(dtype).reshape(shape)
+    elif mmap and count > 0:
+        data = np.memmap(fid, dtype=dtype, mode='r', offset=offset + start*frame_bytes, shape=shape)
+    else:
+        fid.seek(offset + start*frame_bytes)
+        data = np.fromfile(fid, dtype=dtype, count=count*noc).reshape(shape)
+    # Move to the next chunk (chunks are word-aligned)
+    fid.seek(offset + size + size % 2)
     return data
 
 def _read_riff_chunk(fid):
-    global _big_endian
+    big_endian = False
     str1 = fid.read(4)
-    if str1 == 'RIFX':
-        _big_endian = True
-    elif str1 != 'RIFF':
+    if str1 == b'RIFX':
+        big_endian = True
+    elif str1 != b'RIFF':
         raise ValueError("Not a WAV file.")
-    if _big_endian:
+    if big_endian:
         fmt = '>I'
     else:
         fmt = '<I'
     fsize = struct.unpack(fmt, fid.read(4))[0] + 8
     str2 = fid.read(4)
-    if (str2 != 'WAVE'):
+    if (str2 != b'WAVE'):
         raise ValueError("Not a WAV file.")
-    if str1 == 'RIFX':
-        _big_endian = True
-    return fsize
+    return fsize, big_endian
 
 # open a wave-file
-def read(file):
+def read(file, mmap=False, start=None, stop=None):
     """Return the sample rate (in samples/sec) and data from a WAV file
 
     The file can be an open file or a filename.
     The returned sample rate is a Python integer
     The data is returned as a numpy array with a
-        data-type determined from the file.
+        data-type determined from the file. PCM (8, 16, 24 and 32-bit) and 
+        IEEE float (32 and 64-bit) data are supported, including in 
+        WAVE_FORMAT_EXTENSIBLE files. 24-bit data is returned as int32, 
+        left-justified (ie., scaled by 256), so that full scale is the same 
+        as for 32-bit data.
+
+    mmap -- If True, the data is returned as a read-only np.memmap view of 
+            the data chunk, so nothing is read until it is used.
+    start, stop -- The range of frames (samples per channel) to return. The 
+            file is seeked to start, so only the frames requested are read.
     """
     if hasattr(file,'read'):
         fid = file
     else:
         fid = open(file, 'rb')
 
-    fsize = _read_riff_chunk(fid)
+    fsize, big_endian = _read_riff_chunk(fid)
+    if big_endian:
+        fmt = '>I'
+    else:
+        fmt = '<I'
     noc = 1
     bits = 8
+    comp = WAVE_FORMAT_PCM
     while (fid.tell() < fsize):
         # read the next chunk
         chunk_id = fid.read(4)
-        if chunk_id == 'fmt ':
-            size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid)
-        elif chunk_id == 'data':
-            data = _read_data_chunk(fid, noc, bits)
+        if len(chunk_id) < 4:
+            break
+        if chunk_id == b'fmt ':
+            size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid, big_endian)
+        elif chunk_id == b'data':
+            data = _read_data_chunk(fid, noc, bits, big_endian, start, stop, mmap, comp)
         else:
-            warnings.warn("chunk not understood", WavFileWarning)
-            size = struct.unpack('I',fid.read(4))[0]
-            bytes = fid.read(size)
+            # The fact chunk (frame count of non-PCM files) isn't needed
+            if chunk_id != b'fact':
+                warnings.warn("chunk not understood", WavFileWarning)
+            size = struct.unpack(fmt,fid.read(4))[0]
+            fid.seek(size + size % 2, 1)
     fid.close()
     return rate, data
 
+class WavWriter():
+    """Writes a WAV file incrementally
+
+    The header is written when the file is opened, blocks of data are 
+    appended with write, and the sizes in the RIFF header are filled in 
+    by close. Can be used as a context manager.
+
+    filename -- The name of the file to write (will be over-written)
+    rate -- The sample rate (in samples/sec).
+    channels -- The number of channels
+    dtype -- The data-type to write: uint8, int16 or int32 (PCM), or 
+            float32 or float64 (IEEE float). Blocks of other types are 
+            converted to it.
+    bits -- Set to 24 with dtype int32 to write 24-bit PCM. Values are 
+            taken to be left-justified (as returned by read), and the low 
+            byte is dropped.
+    extensible -- If True, a WAVE_FORMAT_EXTENSIBLE header is written. 
+
+    Example:
+        with WavWriter('out.wav', 44100, 2) as w:
+            for block in blocks:
+                w.write(block)
+    """
+    def __init__(self, filename, rate, channels=1, dtype=np.int16, bits=None, extensible=False):
+        self.rate = rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        if self.dtype.kind == 'f':
+            comp = WAVE_FORMAT_IEEE_FLOAT
+        elif self.dtype.kind in 'iu':
+            comp = WAVE_FORMAT_PCM
+        else:
+            raise ValueError("Unsupported data-type: {}".format(self.dtype))
+        if bits is None:
+            bits = self.dtype.itemsize * 8
+        elif bits == 24 and self.dtype != np.dtype('<i4'):
+            raise ValueError("24-bit data must be written from int32")
+        self.bits = bits
+        _data_dtype(comp, bits)
+        self.data_bytes = 0
+        sbytes = rate*(bits // 8)*channels
+        ba = channels * (bits // 8)
+        self.fid = open(filename, 'wb')
+        self.fid.write(b'RIFF')
+        self.fid.write(b'\x00\x00\x00\x00')
+        self.fid.write(b'WAVE')
+        # fmt chunk
+        self.fid.write(b'fmt ')
+        if extensible:
+            self.fid.write(struct.pack('<IHHIIHH', 40, WAVE_FORMAT_EXTENSIBLE, channels, rate, sbytes, ba, bits))
+            self.fid.write(struct.pack('<HHI', 22, bits, 0))
+            self.fid.write(struct.pack('<H', comp) + _subformat_guid_tail)
+        elif comp == WAVE_FORMAT_PCM:
+            self.fid.write(struct.pack('<IHHIIHH', 16, comp, channels, rate, sbytes, ba, bits))
+        else:
+            self.fid.write(struct.pack('<IHHIIHHH', 18, comp, channels, rate, sbytes, ba, bits, 0))
+        # Non-PCM files need a fact chunk, holding the number of frames
+        if comp != WAVE_FORMAT_PCM or extensible:
+            self.fid.write(b'fact')
+            self.fid.write(struct.pack('<I', 4))
+            self._fact_pos = self.fid.tell()
+            self.fid.write(b'\x00\x00\x00\x00')
+        else:
+            self._fact_pos = None
+        # data chunk
+        self.fid.write(b'data')
+        self._data_size_pos = self.fid.tell()
+        self.fid.write(b'\x00\x00\x00\x00')
+
+    def write(self, data):
+        """Appends a block of data, of shape (Nsamples,) or (Nsamples, Nchannels)
+        """
+        data = np.asarray(data)
+        if (data.ndim == 1 and self.channels != 1) or (data.ndim == 2 and data.shape[1] != self.channels):
+            raise ValueError("Expected {} channels".format(self.channels))
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        if self.bits == 24:
+            # Drop the low byte of each (little-endian) int32
+            data = np.ascontiguousarray(data.reshape(-1, 1).view(np.ubyte)[:,1:])
+        data.tofile(self.fid)
+        self.data_bytes += data.nbytes
+
+    def close(self):
+        """Fills in the RIFF header and closes the file
+        """
+        if self.fid.closed:
+            return
+        if self.data_bytes % 2:
+            self.fid.write(b'\x00')
+        size = self.fid.tell()
+        self.fid.seek(4)
+        self.fid.write(struct.pack('<I', size-8))
+        if self._fact_pos is not None:
+            self.fid.seek(self._fact_pos)
+            self.fid.write(struct.pack('<I', self.data_bytes // (self.channels * (self.bits // 8))))
+        self.fid.seek(self._data_size_pos)
+        self.fid.write(struct.pack('<I', self.data_bytes))
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 # Write a wave-file
 # sample rate, data
-def write(filename, rate, data):
+def write(filename, rate, data, bits=None, extensible=False):
     """Write a numpy array as a WAV file
 
     filename -- The name of the file to write (will be over-written)
     rate -- The sample rate (in samples/sec).
-    data -- A 1-d or 2-d numpy array of integer data-type.
-            The bits-per-sample will be determined by the data-type
-            To write multiple-channels, use a 2-d array of shape
+    data -- A 1-d or 2-d numpy array of integer or float data-type.
+            The format and bits-per-sample will be determined by the 
+            data-type. To write multiple-channels, use a 2-d array of shape
             (Nsamples, Nchannels)
+    bits -- Set to 24 to write int32 data as 24-bit PCM (see WavWriter).
+    extensible -- If True, a WAVE_FORMAT_EXTENSIBLE header is written.
 
     Writes a simple uncompressed WAV file.
     """
-    fid = open(filename, 'wb')
-    fid.write('RIFF')
-    fid.write('\x00\x00\x00\x00')
-    fid.write('WAVE')
-    # fmt chunk
-    fid.write('fmt ')
     if data.ndim == 1:
         noc = 1
     else:
         noc = data.shape[1]
-    bits = data.dtype.itemsize * 8
-    sbytes = rate*(bits / 8)*noc
-    ba = noc * (bits / 8)
-    fid.write(struct.pack('<ihHIIHH', 16, 1, noc, rate, sbytes, ba, bits))
-    # data chunk
-    fid.write('data')
-    fid.write(struct.pack('<i', data.nbytes))
-    import sys
-    if data.dtype.byteorder == '>' or (data.dtype.byteorder == '=' and sys.byteorder == 'big'):
-        data = data.byteswap()
-    data.tofile(fid)
-    # Determine file size and place it in correct
-    #  position at start of the file.
-    size = fid.tell()
-    fid.seek(4)
-    fid.write(struct.pack('<i', size-8))
-    fid.close()
+    with WavWriter(filename, rate, noc, data.dtype, bits, extensible) as w:
+        w.write(data)
 
-def wavread(filename):
+def wavread(filename, start=None, stop=None):
     '''Reads wavefiles 
         
         A Matlab-style wavefile reader
@@ -178,17 +331,28 @@ def wavread(filename):
         ----------
         filename : string
             Path to the wavefile to read
+        start, stop : int
+            The range of frames (samples per channel) to read. [default = all]
 
         Returns
         -------
         y : array
-            The wave data
+            The wave data, scaled to +/- 1 whatever the format of the file
     '''
     
-    fs,data = read(filename)
-    return np.float64(data/32768.),fs
+    fs,data = read(filename, start=start, stop=stop)
+    return pcm2float(data),fs
+
+_wav_formats = {
+                'uint8':   (np.uint8, None),
+                'int16':   (np.int16, None),
+                'int24':   (np.int32, 24),
+                'int32':   (np.int32, None),
+                'float32': (np.float32, None),
+                'float64': (np.float64, None),
+               }
 
-def wavwrite(data,fs,filename):
+def wavwrite(data,fs,filename,fmt='int16',extensible=False):
     '''Writes wavefiles 
         
         A Matlab-style wavefile writer
@@ -196,13 +360,38 @@ def wavwrite(data,fs,filename):
         Parameters
         ----------
         data : array
-            Audio data to write
+            Audio data to write, scaled to +/- 1
         fs : Scalar
             The sampling frequency
         filename : string
             Path to the wavefile to write
+        fmt : string
+            The sample format. One of 'uint8', 'int16', 'int24', 'int32', 
+            'float32', or 'float64'. Integer data is clipped to full scale. 
+            [default = 'int16']
+        extensible : bool
+            If True, a WAVE_FORMAT_EXTENSIBLE header is written. 
+            [default = False]
     '''
-    write(filename, fs, np.int16(data*32768))
+    if fmt not in _wav_formats:
+        raise ValueError("fmt must be one of: {}".format(", ".join(sorted(_wav_formats))))
+    dtype, bits = _wav_formats[fmt]
+    dtype = np.dtype(dtype)
+    # Convert a block at a time, to avoid a full-size copy of data
+    if data.ndim == 1:
+        noc = 1
+    else:
+        noc = data.shape[1]
+    n = 65536
+    with WavWriter(filename, fs, noc, dtype, bits, extensible) as w:
+        for i in range(0, data.shape[0], n):
+            block = data[i:i+n]
+            if dtype.kind == 'i':
+                scale = -float(np.iinfo(dtype).min)
+                block = np.clip(block*scale, -scale, scale-1)
+            elif dtype.kind == 'u':
+                block = np.clip(block*128+128, 0, 255)
+            w.write(block.astype(dtype))
 
 
 def pcm2float(sig, dtype=np.float64):
@@ -212,7 +401,9 @@ def pcm2float(sig, dtype=np.float64):
         Parameters
         ----------
         sig : array_like
-            Input array, must have (signed) integral type.
+            Input array. Can be signed integer (16, 32, or left-justified 
+            24-bit data as returned by read), unsigned 8-bit, or float (which 
+            is returned as is, converted to dtype if needed).
         dtype : data-type, optional
             Desired (floating point) data type.
         
@@ -225,11 +416,20 @@ def pcm2float(sig, dtype=np.float64):
         --------
         dtype
     """
-    # TODO: allow unsigned (e.g. 8-bit) data
     sig = np.asarray(sig) # make sure it's a NumPy array
-    assert sig.dtype.kind == 'i', "'sig' must be an array of signed integers!"
+    assert sig.dtype.kind in 'iuf', "'sig' must be an array of integers or floats!"
     dtype = np.dtype(dtype) # allow string input (e.g. 'f')
-    # Note that 'min' has a greater (by 1) absolute value than 'max'!
-    # Therefore, we use 'min' here to avoid clipping.
-    return sig.astype(dtype) / dtype.type(-np.iinfo(sig.dtype).min)
-    
+    if sig.dtype.kind == 'f':
+        return sig.astype(dtype, copy=False)
+    # Scale in place, so that the only copy is the conversion to float
+    out = sig.astype(dtype)
+    if sig.dtype.kind == 'u':
+        # Unsigned data is offset by half of full scale
+        half = dtype.type((np.iinfo(sig.dtype).max + 1) // 2)
+        out -= half
+        out /= half
+    else:
+        # Note that 'min' has a greater (by 1) absolute value than 'max'!
+        # Therefore, we use 'min' here to avoid clipping.
+        out /= dtype.type(-np.iinfo(sig.dtype).min)
+    return out
@@ -103,9 +103,10 @@ def sliding_window(sig, ws, ss = None, flatten = True):
     # Collapse strided so that it has one more dimension than the window.  I.e.,
     # the new array is a flat list of slices.
     meat = len(ws) if ws.shape else 0
-    firstdim = (np.product(newshape[:-meat]),) if ws.shape else ()
+    firstdim = (np.prod(newshape[:-meat]),) if ws.shape else ()
     dim = firstdim + (newshape[-meat:])
-    # remove any dimensions with size 1
-    dim = filter(lambda i : i != 1,dim)
+    # remove any window dimensions with size 1. The first dimension (the 
+    # number of slices) is kept, so that a single slice is still a list of one
+    dim = list(firstdim) + [i for i in dim[len(firstdim):] if i != 1]
     return strided.reshape(dim)
     
@@ -27,6 +27,8 @@ try:
 except ImportError:
     from io import StringIO
 
+import sqlite3
+import collections
 import numpy as np
 
 def read_csv(filename, comment="#"): 
@@ -62,6 +64,69 @@ def read_csv(filename, comment="#"):
                 lines += line + "\n"
     return StringIO(lines)
 
+def read_trial_table(filenames, event='post_trial', columns=None):
+    """Reads the data written by gustav's trial_table (exp.dataTable).
+    
+        Rows from each file are concatenated, in order. Columns that are 
+        missing from some files (eg., a variable that only some experiments 
+        have) are filled with nan (numeric columns) or None.
+        
+        Parameters
+        ----------
+        filenames : string or list of strings
+            The sqlite file(s) to read.
+        event : string
+            The event to return rows for, or None for all events. 
+            [default = 'post_trial']
+        columns : list of strings
+            The columns to return. [default = all columns]
+
+        Returns
+        -------
+        data : OrderedDict
+            A dict of numpy arrays, one per column. Columns in which every 
+            value is a number (or missing) are float arrays, with nan for 
+            missing values; the rest are object arrays.
+            
+        Usage
+        -----
+        data = read_trial_table(glob.glob('data/*.sqlite'))
+        correct = data['response'] == data['var_target']
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    cols = collections.OrderedDict()
+    n = 0
+    for filename in filenames:
+        db = sqlite3.connect(filename)
+        try:
+            if event is None:
+                cur = db.execute('SELECT * FROM events')
+            else:
+                cur = db.execute('SELECT * FROM events WHERE event = ?', (event,))
+            names = [d[0] for d in cur.description]
+            rows = cur.fetchall()
+        finally:
+            db.close()
+        for i, name in enumerate(names):
+            if columns is not None and name not in columns:
+                continue
+            if name not in cols:
+                cols[name] = [None] * n
+            cols[name].extend(row[i] for row in rows)
+        n += len(rows)
+        for name in cols:
+            if len(cols[name]) < n:
+                cols[name].extend([None] * (n - len(cols[name])))
+
+    data = collections.OrderedDict()
+    for name, vals in cols.items():
+        if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in vals):
+            data[name] = np.array([np.nan if v is None else v for v in vals], dtype=float)
+        else:
+            data[name] = np.array(vals, dtype=object)
+    return data
+
 def is_number(s):
     try:
         float(s)
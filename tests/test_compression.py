@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import time
+import numpy as np
+import psylab
+from psylab.signal import compression
+
+fs = 44100
+
+def get_signal(dur=10., seed=0):
+    # A noise carrier with a slow, deep amplitude modulation, so the peak
+    # detector spends plenty of time in both attack and release
+    rs = np.random.RandomState(seed)
+    n = int(dur*fs)
+    t = np.arange(n) / float(fs)
+    return rs.randn(n) * .1 * (1.1 + np.sin(2*np.pi*3*t)) * (t % 1 < .7)
+
+def test_backends_identical():
+    sig = get_signal()
+    ref = psylab.signal.compress(sig, fs, 60, 3, 5, 50, return_gain_function=True, backend='reference')
+    for backend in compression.detector_backends:
+        if backend == 'numba' and compression.numba is None:
+            continue
+        gain = psylab.signal.compress(sig, fs, 60, 3, 5, 50, return_gain_function=True, backend=backend)
+        assert np.array_equal(gain, ref), backend
+
+def test_backends_identical_float32():
+    sig = np.float32(get_signal(dur=2.))
+    ref = compression.peak_detector(sig, fs, 5, 50, backend='reference')
+    d = compression.peak_detector(sig, fs, 5, 50, backend='auto')
+    assert d.dtype == np.float32
+    assert np.array_equal(d, ref)
+
+def test_2d_matches_1d():
+    sig = np.abs(np.random.RandomState(1).randn(20000, 5))
+    attacks = np.array([1, 2, 5, 10, 20])
+    for backend in compression.detector_backends:
+        if backend == 'numba' and compression.numba is None:
+            continue
+        for x in [sig, np.asfortranarray(sig)]:
+            d = compression.peak_detector(x, fs, attacks, 50, backend=backend)
+            for i in range(5):
+                ref = compression.peak_detector(sig[:,i], fs, attacks[i], 50, backend='reference')
+                assert np.array_equal(d[:,i], ref), backend
+
+def test_multiband_matches_single_band():
+    sig = get_signal(dur=2.)
+    cfs = psylab.signal.freqs_logspace(250, 8000, 4)
+    thresholds = np.array([50, 55, 60, 65])
+    attacks = np.array([10, 5, 5, 2])
+    gain = psylab.signal.compress_multiband(sig, fs, cfs, thresholds, 3, attacks, 50, return_gain_function=True)
+    bands = psylab.signal.filter_bank(sig, fs, 3, cfs)
+    for i in range(len(cfs)-1):
+        ref = psylab.signal.compress(bands[:,i], fs, thresholds[i], 3, attacks[i], 50, return_gain_function=True, backend='reference')
+        assert np.array_equal(gain[:,i], ref), i
+
+def test_compressor_blocks_match_offline():
+    sig = get_signal(dur=2.)
+    blocksizes = [1, 2, 100, 511, 4096, 100000]
+    for delay_audio in [False, True]:
+        ref = psylab.signal.compress(sig, fs, 60, 3, 5, 50, delay_audio=delay_audio)
+        c = psylab.signal.Compressor(fs, 60, 3, 5, 50, delay_audio=delay_audio)
+        out = []
+        i = 0
+        while i < sig.size:
+            n = blocksizes[len(out) % len(blocksizes)]
+            out.append(c.process(sig[i:i+n]))
+            i += n
+        assert np.array_equal(np.concatenate(out), ref), delay_audio
+
+def test_make_up():
+    sig = get_signal(dur=2.)
+    rms = lambda x: np.sqrt(np.mean(x**2, axis=0))
+    out = psylab.signal.compress(sig, fs, 60, 3, 5, 50, make_up=True)
+    assert np.allclose(rms(out), rms(sig))
+    c = psylab.signal.Compressor(fs, 60, 3, 5, 50, make_up=True)
+    assert np.allclose(c.process(sig), out)
+    cfs = psylab.signal.freqs_logspace(250, 8000, 4)
+    out = psylab.signal.compress_multiband(sig, fs, cfs, 60, 3, 5, 50, make_up=True, sumchannels=False)
+    assert np.allclose(rms(out), rms(psylab.signal.filter_bank(sig, fs, 3, cfs)))
+    # Silence stays silent, rather than becoming nan
+    silence = np.zeros(1000)
+    assert np.array_equal(psylab.signal.compress(silence, fs, 60, 3, 5, 50, make_up=True), silence)
+    assert np.array_equal(psylab.signal.Compressor(fs, 60, 3, 5, 50, make_up=True).process(silence), silence)
+    assert np.array_equal(psylab.signal.compress_multiband(silence, fs, cfs, 60, 3, 5, 50, make_up=True), silence)
+
+if __name__ == "__main__":
+
+    sig = get_signal()
+    for backend in compression.detector_backends:
+        if backend == 'numba' and compression.numba is None:
+            continue
+        t0 = time.time()
+        gain = psylab.signal.compress(sig, fs, 60, 3, 5, 50, return_gain_function=True, backend=backend)
+        print("{:>10}: {:.3f} s".format(backend, time.time() - t0))
+    test_backends_identical()
+    test_backends_identical_float32()
+    print("All backends produce identical gain")
+
+    for n in [1, 4, 16]:
+        cfs = psylab.signal.freqs_logspace(100, 10000, n)
+        t0 = time.time()
+        gain = psylab.signal.compress_multiband(sig, fs, cfs, 60, 3, 5, 50, return_gain_function=True)
+        print("{:>3} bands: {:.3f} s".format(n, time.time() - t0))
+    test_2d_matches_1d()
+    test_multiband_matches_single_band()
+    test_compressor_blocks_match_offline()
+    test_make_up()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import time
+import numpy as np
+import psylab
+
+def test_convolver_offline():
+    np.random.seed(0)
+    x = np.random.randn(10000)
+    for hlen in [1, 100, 1000, 5000]:
+        h = np.random.randn(hlen)
+        for block_size in [64, 1000, 8192]:
+            y = psylab.signal.Convolver(h, block_size=block_size).convolve(x)
+            assert y.shape == (x.size + h.size - 1,)
+            assert np.allclose(y, np.convolve(x, h))
+
+def test_convolver_streaming():
+    np.random.seed(1)
+    x = np.random.randn(5000)
+    h = np.random.randn(700)
+    c = psylab.signal.Convolver(h, block_size=256)
+    out = []
+    i = 0
+    for n in [10, 256, 1000, 3, 512, 3219]:
+        out.append(c.process(x[i:i+n]))
+        i += n
+    out.append(c.flush())
+    assert np.allclose(np.concatenate(out), np.convolve(x, h))
+    # A multiple of block_size in gives the same number of samples out
+    assert c.process(x[:512]).size == 512
+
+def test_convolver_channels():
+    np.random.seed(2)
+    x1 = np.random.randn(3000)
+    x2 = np.random.randn(3000, 2)
+    h1 = np.random.randn(300)
+    h2 = np.random.randn(300, 2)
+    y = psylab.signal.Convolver(h1, 128).convolve(x2)
+    assert y.shape == (3299, 2)
+    assert np.allclose(y[:,1], np.convolve(x2[:,1], h1))
+    y = psylab.signal.Convolver(h2, 128).convolve(x1)
+    assert y.shape == (3299, 2)
+    assert np.allclose(y[:,0], np.convolve(x1, h2[:,0]))
+    y = psylab.signal.Convolver(h2, 128).convolve(x2)
+    assert np.allclose(y[:,1], np.convolve(x2[:,1], h2[:,1]))
+    # Same as convolve, up to its peak normalization
+    y2 = psylab.signal.convolve(x2, h2)
+    assert np.allclose(y2, y * np.max(np.abs(x2), axis=0) / np.max(np.abs(y), axis=0))
+
+def test_fconv():
+    np.random.seed(3)
+    x = np.random.randn(2000)
+    h = np.random.randn(200)
+    y = psylab.signal.fconv(x, h)
+    ref = np.convolve(x, h)
+    assert np.allclose(y, ref * np.max(np.abs(x)) / np.max(np.abs(ref)))
+
+if __name__ == "__main__":
+    test_convolver_offline()
+    test_convolver_streaming()
+    test_convolver_channels()
+    test_fconv()
+    fs = 44100
+    for xdur, hdur in [(10, 1), (60, 2)]:
+        x = np.random.randn(xdur*fs)
+        h = np.random.randn(hdur*fs) * np.exp(-np.arange(hdur*fs)/float(fs)*6)
+        t0 = time.time()
+        psylab.signal.convolve(x, h)
+        t1 = time.time()
+        psylab.signal.Convolver(h).convolve(x)
+        t2 = time.time()
+        print("x = {} s, h = {} s: convolve {:.2f} s, Convolver {:.2f} s".format(xdur, hdur, t1-t0, t2-t1))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import numpy as np
+import scipy.signal
+import psylab
+from psylab.signal import filter as sigfilter
+
+def test_butter_cache():
+    psylab.signal.filter_cache_clear()
+    b, a = psylab.signal.butter(3, 1000/22050., btype='high')
+    b_ref, a_ref = scipy.signal.butter(3, 1000/22050., btype='high')
+    assert np.array_equal(b, b_ref) and np.array_equal(a, a_ref)
+    # Same filter, different spelling
+    psylab.signal.butter(3., np.array([1000/22050.]), btype='highpass')
+    info = psylab.signal.filter_cache_info()
+    assert info['hits'] == 1 and info['misses'] == 1 and info['size'] == 1
+    # Different output form is a different filter
+    sos = psylab.signal.butter(3, 1000/22050., btype='high', output='sos')
+    assert sos.shape == (2, 6)
+    # Returned coefficients are copies, and can be used with sosfilt
+    sos[:] = 0
+    assert np.any(psylab.signal.butter(3, 1000/22050., btype='high', output='sos'))
+    scipy.signal.sosfilt(psylab.signal.butter(3, .1, output='sos'), np.ones(10))
+    assert psylab.signal.filter_cache_info()['misses'] == 3
+    # fs and analog are passed through to scipy, and are part of the key
+    b, a = psylab.signal.butter(3, 1000., btype='high', fs=44100)
+    assert np.allclose(b, b_ref) and np.allclose(a, a_ref)
+    b, a = psylab.signal.butter(3, 1000., btype='high', analog=True)
+    b_ref, a_ref = scipy.signal.butter(3, 1000., btype='high', analog=True)
+    assert np.array_equal(b, b_ref) and np.array_equal(a, a_ref)
+    assert psylab.signal.filter_cache_info()['misses'] == 5
+
+def test_butter_cache_bounded():
+    psylab.signal.filter_cache_clear()
+    maxsize = sigfilter.filter_cache_maxsize
+    sigfilter.filter_cache_maxsize = 4
+    try:
+        for i in range(10):
+            psylab.signal.butter(2, (i+1)/20.)
+        assert psylab.signal.filter_cache_info()['size'] == 4
+        # The most recent filters are kept
+        psylab.signal.butter(2, 10/20.)
+        assert psylab.signal.filter_cache_info()['hits'] == 1
+        psylab.signal.butter(2, 1/20.)
+        assert psylab.signal.filter_cache_info()['misses'] == 11
+    finally:
+        sigfilter.filter_cache_maxsize = maxsize
+        psylab.signal.filter_cache_clear()
+
+def test_filter_bank_sos():
+    fs = 44100
+    sig = np.random.RandomState(0).randn(fs)
+    cfs = psylab.signal.freqs_logspace(200, 8000, 6)
+    ba = psylab.signal.filter_bank(sig, fs, 3, cfs)
+    sos = psylab.signal.filter_bank(sig, fs, 3, cfs, sos=True)
+    assert np.allclose(ba, sos, atol=1e-8)
+    # 2-d input is filtered channel by channel, and is not modified
+    sig2 = np.tile(sig, (6, 1)).T
+    sos2 = psylab.signal.filter_bank(sig2, fs, 3, cfs, sos=True)
+    assert np.array_equal(sos, sos2)
+    assert np.array_equal(sig2[:,0], sig)
+    # High order, narrow, low-frequency bands stay stable
+    cfs = psylab.signal.freqs_logspace(80, 8000, 64)
+    out = psylab.signal.filter_bank(sig, fs, 6, cfs, sos=True, zero_phase=True)
+    assert np.all(np.isfinite(out)) and np.max(np.abs(out)) < np.max(np.abs(sig))
+
+def test_apply_sos_bank():
+    rs = np.random.RandomState(0)
+    a = psylab.signal.butter(3, .1, output='sos')
+    b = psylab.signal.butter(3, .3, output='sos')
+    groups = [(a, [0, 2]), (b, [1])]
+    # Each channel filtered with its own filter
+    x = rs.randn(1000, 3)
+    y = sigfilter.apply_sos_bank(groups, x, 3, per_channel=True)
+    for i, sos in enumerate([a, b, a]):
+        assert np.allclose(y[:,i], scipy.signal.sosfilt(sos, x[:,i]))
+    # Every filter applied to a batch of signals along axis 1
+    x = rs.randn(1000, 2)
+    y = sigfilter.apply_sos_bank(groups, x, 3)
+    assert y.shape == (1000, 3, 2)
+    for i, sos in enumerate([a, b, a]):
+        assert np.allclose(y[:,i], scipy.signal.sosfilt(sos, x, axis=0))
+
+if __name__ == "__main__":
+
+    test_butter_cache()
+    test_butter_cache_bounded()
+    test_filter_bank_sos()
+    test_apply_sos_bank()
+    print("Filter cache tests passed")
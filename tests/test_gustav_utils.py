@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import tempfile
+import threading
+import collections
+import copy
+import time
+import numpy as np
+import psylab
+from psylab.gustav import utils
+from psylab.signal import waveio
+from psylab.tools import data_tools
+
+def _fresh(cls):
+    # utils.exp's run, var, user and stim are shared classes; give each test 
+    # its own copy of their attributes, so that state doesn't leak between tests
+    obj = cls()
+    for k, v in vars(cls).items():
+        if not k.startswith('__'):
+            setattr(obj, k, copy.deepcopy(v))
+    return obj
+
+def _exp(debug=False):
+    exp = utils.exp()
+    for name in ['run', 'var', 'user', 'stim']:
+        setattr(exp, name, _fresh(getattr(utils.exp, name)))
+    exp.utils = utils
+    exp.debug = debug
+    exp.logConsole = False
+    exp.logFile = os.path.join(tempfile.mkdtemp(), 'log.txt')
+    exp.note = ''
+    exp.run.nblocks = 1
+    return exp
+
+def test_stim_cache():
+    exp = _exp(debug=True)
+    d = tempfile.mkdtemp()
+    files = []
+    for i in range(3):
+        fn = os.path.join(d, '{}.wav'.format(i))
+        waveio.wavwrite(np.random.uniform(-.5, .5, 1000), 8000, fn)
+        files.append(fn)
+    # 1000 float64 samples is 8000 bytes, so room for 2 entries
+    c = utils.stim_cache(exp, 16000)
+    y, fs = c.get(files[0])
+    assert fs == 8000 and y.size == 1000
+    c.get(files[0])
+    assert c.info()['hits'] == 1 and c.info()['misses'] == 1
+    scale = lambda x, fs, gain: x*gain
+    y2, fs = c.get(files[0], scale, gain=2)
+    assert np.allclose(y2, y*2)
+    assert c.get(files[0], scale, gain=3)[0] is not y2
+    assert c.get(files[0], scale, gain=3)[0] is not y2
+    assert c.info()['hits'] == 2
+    assert c.info()['nbytes'] <= 16000
+    # Least recently used entries were dropped
+    c.get(files[0])
+    assert c.info()['misses'] == 4
+    assert not y.flags.writeable
+    assert "Stim cache hit" in open(exp.logFile).read()
+
+def test_stim_cache_functions():
+    exp = _exp()
+    fn = os.path.join(tempfile.mkdtemp(), 'x.wav')
+    waveio.wavwrite(np.random.uniform(-.5, .5, 1000), 8000, fn)
+    c = utils.stim_cache(exp, 1e6)
+    y, fs = c.get(fn)
+    # Different functions with the same name and params
+    y1 = c.get(fn, lambda x, fs, g: x*g, g=2)[0]
+    y2 = c.get(fn, lambda x, fs, g: x/g, g=2)[0]
+    assert np.allclose(y1, y*2) and np.allclose(y2, y/2)
+    # Closures that differ only in their captured values
+    def make(k):
+        def process(x, fs, g):
+            return x*g + k
+        return process
+    y3 = c.get(fn, make(1), g=2)[0]
+    y4 = c.get(fn, make(np.ones(1)*2), g=2)[0]
+    assert np.allclose(y3, y*2 + 1) and np.allclose(y4, y*2 + 2)
+    assert c.info()['hits'] == 0
+    # The same function again is a hit
+    c.get(fn, make(1), g=2)
+    assert c.info()['hits'] == 1
+
+def test_prefetch():
+    from psylab.gustav.methods import constant, adaptive
+    exp = _exp()
+    exp.method = constant
+    exp.var.constant = {'trialsperblock': 3}
+    exp.var.current = {'level': 1}
+    exp.prefetch = True
+    made = []
+    def generate_stimulus(exp, trial, current):
+        time.sleep(.01)
+        made.append(threading.current_thread().name)
+        return (trial, current['level'])
+    exp.generate_stimulus = generate_stimulus
+    got = []
+    for trial in range(3):
+        exp.run.trials_block = trial
+        exp.utils.get_stimulus(exp)
+        got.append(exp.stim.buffer)
+        exp.utils.prefetch_stimulus(exp)
+        # The prefetch works from a snapshot, not the live variables
+        exp.var.current['level'] = None
+        exp.var.current = {'level': 1}
+    exp.utils.discard_prefetched(exp)
+    # Stimuli arrive in order; only the first of the block is made in the 
+    # main thread, and nothing is made for the next block
+    assert got == [(0, 1), (1, 1), (2, 1)]
+    assert made[0] == threading.current_thread().name
+    assert made[1] != made[0] and made[2] != made[0]
+    # Adaptive tracks are generated synchronously
+    exp.method = adaptive
+    del made[:]
+    exp.utils.get_stimulus(exp)
+    exp.utils.prefetch_stimulus(exp)
+    assert exp.run.prefetched is None
+    assert made == [threading.current_thread().name]
+
+def _build_stimulus(args):
+    trial, n = args
+    return np.ones(n) * trial
+
+def test_precompute_block():
+    from psylab.gustav.methods import constant
+    class experiment:
+        @staticmethod
+        def stimulus_args(exp, trial):
+            return (trial, 1000)
+        build_stimulus = staticmethod(_build_stimulus)
+    exp = _exp()
+    exp.experiment = experiment
+    exp.method = constant
+    exp.var.constant = {'trialsperblock': 10, 'startblock': 1, 'starttrial': 1, 
+                        'precompute': True, 'processes': 2, 
+                        # Room for 4 stimuli of 8000 bytes
+                        'precompute_maxbytes': 32000}
+    exp.run.block = 0
+    exp.run.trials_block = 0
+    try:
+        constant.pre_block(exp)
+        assert len(exp.run.block_store.store) == 4
+        for trial in range(10):
+            exp.run.trials_block = trial
+            exp.utils.get_stimulus(exp)
+            assert np.all(exp.stim.buffer == trial)
+            assert exp.run.block_store.nbytes <= 32000
+        log = open(exp.logFile).read()
+        assert "Precomputed 4 of 10 stimuli" in log
+        assert "Precomputed 4 more stimuli" in log
+        exp.utils.discard_prefetched(exp)
+        assert exp.run.block_store is None
+    finally:
+        constant.post_exp(exp)
+    assert exp.run.pool is None
+
+def test_expanded_vals():
+    exp = _exp()
+    exp.name = 'myexp'
+    exp.subjID = 's1'
+    exp.run.block = 1
+    exp.run.nblocks = 4
+    exp.run.trials_block = 3
+    exp.run.trials_exp = 13
+    exp.run.condition = 2
+    exp.run.response = '3'
+    exp.var.nlevels_total = 6
+    exp.var.current = collections.OrderedDict([('snr', '3'), ('freq', '500')])
+    exp.var.varlist = ['snr', 'freq']
+    exp.var.dynamic = {'value': 4.5}
+    exp.user.level = 60
+    s = "$name,$subj,$trial_block,$trial,$blocks,$block,$conditions,$condition,$response"
+    assert utils.get_expanded_vals_in_string(s, exp) == "myexp,s1,4,14,4,2,6,3,3"
+    s = "$currentvarsvals[' ; '] | $currentvars[] | @currentvars[';'] | $var[snr]"
+    assert utils.get_expanded_vals_in_string(s, exp) == "snr = 3 ; freq = 500 | 3,500 | snr;freq | 3"
+    s = "$user[level] @user[level] $dynamic[value] $user[nope] $foo"
+    assert utils.get_expanded_vals_in_string(s, exp) == "60 level 4.5 $user[nope] $foo"
+    # Compiled once, rendered with current values
+    exp.user.level = 70
+    assert utils.get_expanded_vals_in_string(s, exp) == "70 level 4.5 $user[nope] $foo"
+
+def test_data_writer():
+    exp = _exp()
+    # Buffering is opt-in; by default every write goes straight to disk
+    assert not exp.bufferData and not exp.asyncWriter
+    exp.dataFsyncInterval = 0
+    fn = os.path.join(tempfile.mkdtemp(), 'data.py')
+    utils.open_writer(exp)
+    try:
+        for i in range(100):
+            utils.write_data(u"trial {}\n".format(i), fn)
+        assert len(utils._writer.files) == 1
+        utils.flush_writer()
+        with open(fn) as f:
+            lines = f.readlines()
+        assert lines[0] == "# -*- coding: utf-8 -*-\n" and lines[-1] == "trial 99\n"
+    finally:
+        utils.close_writer()
+    assert utils._writer is None
+    # Without a writer, files are appended to
+    utils.write_data(u"trial 100\n", fn)
+    with open(fn) as f:
+        assert f.read().count("trial") == 101
+
+def test_async_writer():
+    exp = _exp(debug=True)
+    exp.asyncWriter = True
+    fn = os.path.join(tempfile.mkdtemp(), 'data.py')
+    utils.open_writer(exp)
+    try:
+        for i in range(1000):
+            utils.write_data(u"trial {}\n".format(i), fn)
+        utils.debug(exp, "End Event: post_trial")
+        utils.flush_writer()
+        info = utils._writer.info()
+        assert info['depth'] == 0 and info['writes'] == 1001 and info['max_depth'] > 0
+        with open(fn) as f:
+            lines = f.readlines()[2:]
+        assert lines == ["trial {}\n".format(i) for i in range(1000)]
+        with open(exp.logFile) as f:
+            assert "[queue " in f.read()
+    finally:
+        utils.close_writer()
+
+def test_trial_table():
+    exp = _exp()
+    exp.name = 'myexp'
+    exp.subjID = 's1'
+    fn = os.path.join(tempfile.mkdtemp(), 'data.sqlite')
+    for session in range(2):
+        table = utils.trial_table(fn)
+        exp.var.current = collections.OrderedDict([('snr', '-3'), ('masker', 'speech')])
+        exp.var.dynamic = {}
+        if session == 1:
+            exp.var.dynamic = {'value': np.float64(4.5), 'track': [1, 2]}
+        for trial in range(5):
+            exp.run.trials_exp = trial
+            exp.run.response = str(trial % 2)
+            table.write(exp, 'pre_trial')
+            table.write(exp, 'post_trial')
+        table.close()
+    data = data_tools.read_trial_table(fn)
+    assert len(data['trial']) == 10 and len(set(data['session'])) == 2
+    assert data['var_snr'].dtype == float and np.all(data['var_snr'] == -3)
+    assert data['trial'].tolist() == [1, 2, 3, 4, 5] * 2
+    assert np.isnan(data['dyn_value'][0]) and data['dyn_value'][-1] == 4.5
+    assert data['dyn_track'][-1] == '[1, 2]' and data['var_masker'][0] == 'speech'
+    assert len(data_tools.read_trial_table([fn, fn], event=None)['event']) == 40
+    # A column whose first value is None still gets its type from later values
+    fn = os.path.join(tempfile.mkdtemp(), 'data.sqlite')
+    table = utils.trial_table(fn)
+    for value in [None, None, 2.5, '3', None]:
+        exp.var.dynamic = {'value': value}
+        table.write(exp, 'post_trial')
+    table.close()
+    data = data_tools.read_trial_table(fn)
+    assert data['dyn_value'].dtype == float
+    assert np.array_equal(data['dyn_value'], [np.nan, np.nan, 2.5, 3, np.nan], equal_nan=True)
+
+def test_trial_timer():
+    exp = _exp()
+    exp.run.timer = timer = utils.trial_timer()
+    utils.do_event(exp, 'pre_block')
+    for trial in range(20):
+        utils.do_event(exp, 'pre_trial')
+        with timer('present_trial'):
+            time.sleep(.002)
+        utils.do_event(exp, 'post_trial')
+    s = "$timing[present_trial.n] $timing[present_trial] $timing[present_trial.p95] $timing[nope]"
+    n, last, p95, nope = utils.get_expanded_vals_in_string(s, exp).split(" ")
+    assert n == "20" and 2 <= float(last) < 100 and float(p95) >= 2 and nope == "$timing[nope]"
+    utils.do_event(exp, 'post_block')
+    stats = timer.blocks[0][1]
+    assert list(stats.keys()) == ['pre_block', 'pre_trial', 'present_trial', 'post_trial', 'post_block']
+    assert stats['present_trial']['mean'] <= stats['present_trial']['max']
+    report = timer.report()
+    assert "# Block 1" in report and "# Session" in report and "present_trial" in report
+
+def _slow_pre_trial(exp):
+    x = [np.zeros(10000) for i in range(10)]
+    time.sleep(.002)
+
+def test_profiler():
+    exp = _exp()
+    exp.profile = ['time', 'cprofile', 'tracemalloc']
+    exp.pre_trial_ = [_slow_pre_trial]
+    exp.generate_stimulus = lambda exp: np.zeros(100)
+    utils.profile_functions(exp)
+    try:
+        assert exp.pre_trial_[0].__name__ == '_slow_pre_trial'
+        for trial in range(5):
+            utils.do_event(exp, 'pre_trial')
+            exp.generate_stimulus(exp)
+        label = [k for k in exp.run.profiler.stats if k.endswith('._slow_pre_trial')][0]
+        stats = exp.run.profiler.stats[label]
+        assert stats['calls'] == 5 and stats['max'] >= 2e6 and stats['peak'] >= 800000
+        report = exp.run.profiler.report()
+        lines = report.split("\n")
+        assert "_slow_pre_trial" in lines[2] and "generate_stimulus: " in lines[3]
+        assert "cumulative" in report
+    finally:
+        exp.run.profiler.stop()
+
+if __name__ == "__main__":
+    test_stim_cache()
+    test_stim_cache_functions()
+    test_prefetch()
+    test_precompute_block()
+    test_expanded_vals()
+    test_data_writer()
+    test_async_writer()
+    test_trial_table()
+    test_trial_timer()
+    test_profiler()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import tempfile
+import time
+import numpy as np
+import psylab
+
+def _make_bank(n_taps=128, n_az=72):
+    np.random.seed(0)
+    data = np.random.randn(n_taps, n_az) * np.exp(-np.arange(n_taps)/20.)[:,np.newaxis]
+    path = os.path.join(tempfile.mkdtemp(), 'hrtf.npy')
+    np.save(path, data)
+    return data, path
+
+def test_hrtf_data():
+    data, path = _make_bank()
+    h = psylab.signal.hrtf_data(path, mmap=True)
+    assert np.allclose(h.get_data(10), data[:,2])
+    l,r = h.get_left_right_data(30)
+    assert np.allclose(l, data[:,6]) and np.allclose(r, data[:,66])
+    sig = np.random.randn(1000)
+    assert np.allclose(h.apply_data(sig, 10), np.convolve(sig, data[:,2]))
+    assert h.apply_left_right_data(sig, 30).shape == (1127, 2)
+    assert np.allclose(h.get_interp_data(7.5), (data[:,1]+data[:,2])/2)
+
+def test_hrtf_renderer_static():
+    data, path = _make_bank()
+    r = psylab.signal.HrtfRenderer(path)
+    sig = np.random.randn(5000)
+    y = r.render(sig, 30)
+    assert y.shape == (5127, 2)
+    assert np.allclose(y[:,0], np.convolve(sig, data[:,6]))
+    assert np.allclose(y[:,1], np.convolve(sig, data[:,66]))
+    r.render(sig, 30)
+    assert r.cache_info()['hits'] == 1
+
+def test_hrtf_renderer_trajectory():
+    data, path = _make_bank()
+    r = psylab.signal.HrtfRenderer(path, block_size=256)
+    sig = np.random.randn(5000)
+    # A constant trajectory is the same as a static source
+    y = r.render(sig, np.ones(sig.size)*30)
+    assert np.allclose(y, r.render(sig, 30))
+    # A moving source is continuous, and uses few distinct spectra
+    az = np.linspace(0, 90, sig.size)
+    y = r.render(sig, az)
+    assert y.shape == (5127, 2)
+    assert np.all(np.isfinite(y))
+    assert r.cache_info()['size'] <= 2 + int(np.ceil(5127/256.))
+
+if __name__ == "__main__":
+    test_hrtf_data()
+    test_hrtf_renderer_static()
+    test_hrtf_renderer_trajectory()
+    data, path = _make_bank(512, 72)
+    sig = np.random.randn(44100*10)
+    az = np.linspace(0, 720, sig.size)
+    h = psylab.signal.hrtf_data(path)
+    t0 = time.time()
+    for a in range(0, 360, 10):
+        h.apply_left_right_data(sig, a)
+    t1 = time.time()
+    r = psylab.signal.HrtfRenderer(path)
+    for a in range(0, 360, 10):
+        r.render(sig, a)
+    t2 = time.time()
+    r.render(sig, az)
+    t3 = time.time()
+    print("36 azimuths, 10 s: hrtf_data {:.2f} s, HrtfRenderer {:.2f} s".format(t1-t0, t2-t1))
+    print("10 s moving source: {:.2f} s".format(t3-t2))
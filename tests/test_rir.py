@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import time
+import numpy as np
+import psylab
+
+fs = 44100
+r = .968
+rm = [4.59, 6.64, 2.6]
+src = [1.43, 6.25, 1.3]
+mic = [2.8, 2.5, 1.3]
+
+def _rir_loop(fs, rm, src, mic, n, r):
+    # Reference: a python loop over the virtual sources, summing arrivals 
+    # that fall on the same sample
+    nn = np.arange(-n, n+1)
+    rms = nn + 0.5 - 0.5*(-1.)**nn
+    srcs = (-1.)**nn
+    h = {}
+    for a in range(len(nn)):
+        for b in range(len(nn)):
+            for c in range(len(nn)):
+                x = srcs[a]*src[0] + rms[a]*rm[0] - mic[0]
+                y = srcs[b]*src[1] + rms[b]*rm[1] - mic[1]
+                z = srcs[c]*src[2] + rms[c]*rm[2] - mic[2]
+                d = np.sqrt(x**2 + y**2 + z**2)
+                t = int(np.round(fs*d/343))
+                e = r**(abs(nn[a]) + abs(nn[b]) + abs(nn[c])) / d
+                h[t] = h.get(t, 0) + e
+    out = np.zeros(max(h.keys())+1)
+    for t,e in h.items():
+        out[t] = e
+    return out/np.max(np.abs(out))
+
+def test_rir_matches_loop():
+    h = psylab.signal.rir(fs, rm, src, mic, 4, r)
+    ref = _rir_loop(fs, rm, src, mic, 4, r)
+    assert h.shape == ref.shape
+    assert np.allclose(h, ref)
+
+def test_rir_fractional_delay():
+    # At integer delays the interpolator reduces to nearest-sample placement
+    from psylab.signal.rir import _accumulate_arrivals
+    delays = np.array([20., 35., 35., 60.])
+    amps = np.array([1., .5, .25, -.3])
+    h = _accumulate_arrivals(delays, amps)
+    hf = _accumulate_arrivals(delays, amps, fractional_delay=True)
+    assert np.allclose(hf[:h.size], h)
+    assert np.allclose(hf[h.size:], 0)
+    # A half-sample delay splits the arrival evenly between its neighbours
+    hf = _accumulate_arrivals(np.array([20.5]), np.array([1.]), fractional_delay=True)
+    assert np.allclose(hf[20], hf[21])
+
+    hf = psylab.signal.rir(fs, rm, src, mic, 4, r, fractional_delay=True)
+    assert np.all(np.isfinite(hf))
+    assert np.max(np.abs(hf)) == 1
+
+def test_rir_chunked():
+    h = psylab.signal.rir(fs, rm, src, mic, 6, r)
+    for chunk_size in [1, 200, 1000]:
+        hc = psylab.signal.rir(fs, rm, src, mic, 6, r, chunk_size=chunk_size)
+        assert hc.shape == h.shape
+        assert np.allclose(hc, h)
+    h = psylab.signal.rir(fs, rm, src, mic, 6, r, fractional_delay=True)
+    hc = psylab.signal.rir(fs, rm, src, mic, 6, r, fractional_delay=True, chunk_size=500)
+    assert np.allclose(hc, h)
+
+def test_rir_pruning():
+    h = psylab.signal.rir(fs, rm, src, mic, 6, r)
+    hp = psylab.signal.rir(fs, rm, src, mic, 6, r, max_time=.05)
+    assert hp.size == int(.05*fs)+1
+    assert np.allclose(hp, h[:hp.size] / np.max(np.abs(h[:hp.size])))
+    # A generous floor removes nothing
+    hp = psylab.signal.rir(fs, rm, src, mic, 6, r, min_level=200)
+    assert np.allclose(hp, h)
+    hp = psylab.signal.rir(fs, rm, src, mic, 6, r, min_level=20)
+    assert np.count_nonzero(hp) < np.count_nonzero(h)
+
+def test_rir_multi():
+    mics = [[2.71, 2.5, 1.3], [2.89, 2.5, 1.3], [1., 1., 1.]]
+    h = psylab.signal.rir_multi(fs, rm, src, mics, 6, r)
+    assert h.shape[1] == 3
+    singles = [psylab.signal.rir(fs, rm, src, m, 6, r) for m in mics]
+    for i in range(3):
+        # Each column is proportional to the single-receiver response
+        hi = h[:singles[i].size,i]
+        assert np.allclose(hi/np.max(np.abs(hi)), singles[i])
+        assert np.allclose(h[singles[i].size:,i], 0)
+    # One source per receiver
+    srcs = [src, [1., 2., 1.], src]
+    h = psylab.signal.rir_multi(fs, rm, srcs, mics, 6, r, chunk_size=300, fractional_delay=True)
+    hi = psylab.signal.rir(fs, rm, srcs[1], mics[1], 6, r, fractional_delay=True)
+    assert np.allclose(h[:hi.size,1]/np.max(np.abs(h[:,1])), hi)
+
+if __name__ == "__main__":
+    test_rir_matches_loop()
+    test_rir_fractional_delay()
+    test_rir_chunked()
+    test_rir_pruning()
+    test_rir_multi()
+    for n in [12, 25, 50]:
+        t0 = time.time()
+        psylab.signal.rir(fs, rm, src, mic, n, r)
+        t1 = time.time()
+        psylab.signal.rir(fs, rm, src, mic, n, r, fractional_delay=True)
+        t2 = time.time()
+        print("n = {:3d}: {:.3f} s, fractional_delay: {:.3f} s".format(n, t1-t0, t2-t1))
+    mics = np.column_stack((np.linspace(1, 3.5, 16), np.ones(16)*2.5, np.ones(16)*1.3))
+    t0 = time.time()
+    for m in mics:
+        psylab.signal.rir(fs, rm, src, m, 25, r)
+    t1 = time.time()
+    psylab.signal.rir_multi(fs, rm, src, mics, 25, r)
+    t2 = time.time()
+    print("16 receivers, n = 25: rir {:.3f} s, rir_multi: {:.3f} s".format(t1-t0, t2-t1))
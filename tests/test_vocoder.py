@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import time
+import tempfile
+import numpy as np
+from scipy.io import wavfile
+import psylab
+
+fs = 44100
+
+def test_vocoder_plan():
+    rs = np.random.RandomState(0)
+    sig = rs.randn(fs)
+    plan = psylab.signal.VocoderPlan(fs, 16, 100, 8000)
+    ref = psylab.signal.vocoder_vect(sig, fs, 16, 100, 8000)
+    voc = plan.apply(sig)
+    assert np.allclose(voc, ref, atol=1e-6)
+    # A batch of signals of different lengths
+    sigs = [rs.randn(n) for n in (fs//2, fs, fs//4)]
+    vocs = plan.apply(sigs)
+    for s, v in zip(sigs, vocs):
+        assert v.shape == s.shape
+        assert np.array_equal(v, plan.apply(s))
+
+def test_vocoder_fft():
+    rs = np.random.RandomState(0)
+    t = np.arange(fs*2) / float(fs)
+    # A modulated band of noise at 1 kHz, and a weaker one at 3.5 kHz
+    sig = (psylab.signal.filter_bank(rs.randn(t.size), fs, 4, np.array([800., 1200.])) * (1 + np.sin(2*np.pi*4*t)) + 
+           .2 * psylab.signal.filter_bank(rs.randn(t.size), fs, 4, np.array([3000., 4000.])))
+    cfs = psylab.signal.freqs_logspace(100, 8000, 8)
+    for noise in [True, False]:
+        voc = psylab.signal.vocoder_fft(sig, fs, 8, 100, 8000, noise=noise)
+        assert voc.shape == sig.shape
+        assert np.allclose(psylab.signal.rms(voc), psylab.signal.rms(sig))
+        # Channel levels follow the input
+        lev_in = np.sqrt(np.mean(psylab.signal.filter_bank(sig, fs, 3, cfs, sos=True)**2, axis=0))
+        lev_out = np.sqrt(np.mean(psylab.signal.filter_bank(voc, fs, 3, cfs, sos=True)**2, axis=0))
+        assert np.argmax(lev_out) == np.argmax(lev_in)
+    voc = psylab.signal.vocoder_fft(sig, fs, 8, 100, 8000, sumchannels=False)
+    assert voc.shape == (sig.size, 8)
+
+def test_vocoder_ace():
+    rs = np.random.RandomState(0)
+    sig = rs.randn(fs) * np.repeat(rs.rand(50), fs//50)
+    voc = psylab.signal.vocoder_vect(sig, fs, 22, 188, 7938, ace=8)
+    assert voc.shape == sig.shape and np.all(np.isfinite(voc))
+    assert np.allclose(psylab.signal.rms(voc), psylab.signal.rms(sig))
+    peaks, rms = psylab.signal.pick_peaks(np.abs(rs.randn(fs, 22)), 8, 882)
+    assert peaks.shape == (fs, 8)
+
+def test_vocoder_ace_short():
+    # Signals that fit in a single (or just over one) ace_window frame
+    rs = np.random.RandomState(0)
+    for n in [441, 882, 883]:
+        voc = psylab.signal.vocoder_vect(rs.randn(n), fs, 22, 188, 7938, ace=8)
+        assert voc.shape == (n,) and np.all(np.isfinite(voc))
+
+def test_vocoder_corpus():
+    rs = np.random.RandomState(0)
+    indir = os.path.join(tempfile.mkdtemp(), 'speech')
+    os.makedirs(indir)
+    for i in range(3):
+        wavfile.write(os.path.join(indir, '{}.wav'.format(i)), 16000, np.int16(rs.randn(4000)*3000))
+    params = {'channels': [4, 8], 'inlo': [100], 'inhi': [6000], 'noise': [True]}
+    outdirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    np.random.seed(1)
+    state = np.random.get_state()
+    for outdir, processes in zip(outdirs, [1, 2]):
+        written, skipped = psylab.signal.vocoder_corpus(indir, outdir, params, processes=processes, verbose=False)
+        assert len(written) == 6 and len(skipped) == 0
+    # The caller's random state is left alone
+    assert np.array_equal(np.random.get_state()[1], state[1])
+    # Same output, however many processes
+    for f in written:
+        rel = os.path.relpath(f, outdirs[1])
+        a = wavfile.read(os.path.join(outdirs[0], rel))[1]
+        b = wavfile.read(f)[1]
+        assert a.dtype == np.int16 and np.array_equal(a, b) and np.any(a != 0)
+    # Up to date files are skipped, unless overwrite is set
+    written, skipped = psylab.signal.vocoder_corpus(indir, outdirs[0], params, processes=1, verbose=False)
+    assert len(written) == 0 and len(skipped) == 6
+    written, skipped = psylab.signal.vocoder_corpus(indir, outdirs[0], params, processes=1, overwrite=True, verbose=False)
+    assert len(written) == 6 and len(skipped) == 0
+
+if __name__ == "__main__":
+
+    sig = np.random.randn(fs*3)
+    plan = psylab.signal.VocoderPlan(fs, 16, 100, 8000)
+    plan.apply(sig)
+    t0 = time.time()
+    for i in range(10):
+        psylab.signal.vocoder_vect(sig, fs, 16, 100, 8000)
+    print("vocoder_vect: {:.3f} s".format(time.time() - t0))
+    t0 = time.time()
+    for i in range(10):
+        plan.apply(sig)
+    print(" VocoderPlan: {:.3f} s".format(time.time() - t0))
+    test_vocoder_plan()
+
+    print("\nchannels  vocoder  vocoder_vect  vocoder_fft")
+    for channels in [4, 16, 64]:
+        times = []
+        for func in [psylab.signal.vocoder, psylab.signal.vocoder_vect, psylab.signal.vocoder_fft]:
+            t0 = time.time()
+            func(sig, fs, channels, 100, 8000, noise=True)
+            times.append(time.time() - t0)
+        print("{:>8}   {:.2f} s        {:.2f} s       {:.2f} s".format(channels, *times))
+    test_vocoder_fft()
+
+    sig = np.random.randn(fs*10)
+    t0 = time.time()
+    psylab.signal.vocoder_vect(sig, fs, 22, 188, 7938, ace=8)
+    print("\n8 of 22 (ace), 10 s of audio: {:.2f} s".format(time.time() - t0))
+    test_vocoder_ace()
+    test_vocoder_ace_short()
+    test_vocoder_corpus()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join("..","src"))
+import tempfile
+import numpy as np
+from scipy.io import wavfile
+from psylab.signal import waveio
+
+def _tmp(name):
+    return os.path.join(tempfile.mkdtemp(), name)
+
+def test_write_read():
+    np.random.seed(0)
+    data = np.int16(np.random.randint(-32768, 32767, (1000, 3)))
+    fn = _tmp('a.wav')
+    waveio.write(fn, 44100, data)
+    fs, ref = wavfile.read(fn)
+    assert fs == 44100 and np.array_equal(ref, data)
+    fs, out = waveio.read(fn)
+    assert fs == 44100 and np.array_equal(out, data)
+
+def test_read_range_and_mmap():
+    np.random.seed(1)
+    data = np.int16(np.random.randint(-32768, 32767, (1000, 2)))
+    fn = _tmp('b.wav')
+    wavfile.write(fn, 22050, data)
+    fs, out = waveio.read(fn, start=100, stop=250)
+    assert np.array_equal(out, data[100:250])
+    fs, out = waveio.read(fn, start=-10)
+    assert np.array_equal(out, data[-10:])
+    fs, out = waveio.read(fn, mmap=True)
+    assert isinstance(out, np.memmap)
+    assert np.array_equal(out, data)
+    fs, out = waveio.read(fn, mmap=True, start=500, stop=510)
+    assert np.array_equal(out, data[500:510])
+    y, fs = waveio.wavread(fn, start=10, stop=20)
+    assert np.allclose(y, data[10:20]/32768.)
+
+def test_writer():
+    np.random.seed(2)
+    data = np.random.uniform(-.9, .9, 10000)
+    fn = _tmp('c.wav')
+    with waveio.WavWriter(fn, 8000) as w:
+        for i in range(0, data.size, 999):
+            w.write(np.int16(data[i:i+999]*32768))
+    fs, out = wavfile.read(fn)
+    assert fs == 8000
+    assert np.array_equal(out, np.int16(data*32768))
+    fn2 = _tmp('d.wav')
+    waveio.wavwrite(data, 8000, fn2)
+    assert open(fn, 'rb').read() == open(fn2, 'rb').read()
+
+def test_formats():
+    np.random.seed(3)
+    sig = np.random.uniform(-.99, .99, (2000, 2))
+    for fmt in ['uint8', 'int16', 'int24', 'int32', 'float32', 'float64']:
+        for extensible in [False, True]:
+            fn = _tmp('e.wav')
+            waveio.wavwrite(sig, 48000, fn, fmt=fmt, extensible=extensible)
+            # scipy reads 24-bit as left-justified int32, as we do
+            fs, ref = wavfile.read(fn)
+            fs, data = waveio.read(fn)
+            assert data.dtype == ref.dtype
+            assert np.array_equal(data, ref)
+            y, fs = waveio.wavread(fn)
+            assert fs == 48000
+            assert np.allclose(y, sig, atol=1/127.)
+            if fmt not in ['uint8', 'int16']:
+                assert np.allclose(y, sig, atol=1e-6)
+    fs, part = waveio.read(fn, start=5, stop=7)
+    assert np.array_equal(part, data[5:7])
+
+def test_int24_range():
+    np.random.seed(4)
+    data = np.int32(np.random.randint(-2**23, 2**23, (500, 3)) * 256)
+    fn = _tmp('f.wav')
+    waveio.write(fn, 44100, data, bits=24)
+    assert os.path.getsize(fn) == 44 + 500*3*3
+    fs, out = waveio.read(fn, start=100, stop=200)
+    assert np.array_equal(out, data[100:200])
+    assert np.allclose(waveio.pcm2float(out), data[100:200] / 2.**31)
+
+def test_pcm2float():
+    assert np.allclose(waveio.pcm2float(np.array([0, 128, 255], dtype=np.uint8)), [-1, 0, 127/128.])
+    assert np.allclose(waveio.pcm2float(np.array([-32768, 16384], dtype=np.int16)), [-1, .5])
+    f = np.array([.5, -.25], dtype=np.float32)
+    assert waveio.pcm2float(f, np.float32) is f
+
+if __name__ == "__main__":
+    test_write_read()
+    test_read_range_and_mmap()
+    test_writer()
+    test_formats()
+    test_int24_range()
+    test_pcm2float()